@@ -0,0 +1,359 @@
+'''
+Asterisk/Async.py: Manager API sessions multiplexed on an asyncore loop.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import asyncore, socket, errno, time, weakref
+import Asterisk.Util
+from Asterisk.Manager import BaseManager, CoreActions, ZapataActions, \
+    PacketReader, ActionFuture, AuthenticationFailure, CommunicationError, \
+    GoneAwayError
+
+
+
+
+class _Dispatcher(asyncore.dispatcher):
+    'asyncore glue passing socket activity to its AsyncManager.'
+
+    def __init__(self, manager, map):
+        asyncore.dispatcher.__init__(self, map = map)
+        self.manager = manager
+
+    def handle_connect(self):
+        pass
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return not self.connected or bool(self.manager.outgoing)
+
+    def handle_read(self):
+        self.manager.handle_read()
+
+    def handle_write(self):
+        self.manager.handle_write()
+
+    def handle_close(self):
+        self.manager.handle_close(GoneAwayError('Asterisk Manager connection has gone away.'))
+
+    def handle_error(self):
+        self.manager.handle_error()
+
+
+
+
+class AsyncManager(BaseManager):
+    '''
+    Base protocol implementation for a Manager API session driven by an
+    asyncore loop, so that a single thread may serve many PBX connections.
+
+    Actions sent with send_action() return ActionFuture objects whose
+    callbacks run from the loop, and events are fired through <events> as
+    they arrive. The blocking CoreActions methods remain usable: while one
+    waits for its response the shared loop keeps serving every other session.
+    '''
+
+    def __init__(self, address, username, secret, listen_events = True,
+            timeout = None, event_mask = None, lazy_events = False,
+            compact_packets = False, map = None):
+        '''
+        Begin connecting to the PBX instance running at <address>,
+        authenticating using <username> and <secret> once the banner has been
+        received. The session is registered with the asyncore socket map
+        <map>, or the global map if None. <ready> is an ActionFuture resolved
+        when authentication completes. <event_mask>, <lazy_events> and
+        <compact_packets> are as for BaseManager.
+        '''
+
+        self.address = address
+        self.username = username
+        self.secret = secret
+        self.listen_events = listen_events
+        self.event_mask = event_mask
+        self.lazy_events = lazy_events
+        self.compact_packets = compact_packets
+        self.events = Asterisk.Util.EventCollection()
+        self.timeout = timeout
+
+        # Configure logging:
+        self.log = self.getLogger()
+        self.cacheLogLevels()
+        self.log.debug('Initialising.')
+
+        if map is None:
+            map = asyncore.socket_map
+
+        self.map = map
+        self.dispatcher = _Dispatcher(self, map)
+        self.dispatcher.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.dispatcher.connect(address)
+
+        self.sock = self.dispatcher.socket
+        self.fileno = self.sock.fileno
+        self.reader = PacketReader(self.sock, self.timeout)
+        if lazy_events:
+            self.reader.parser.wants_event = self._wants_event
+        if compact_packets:
+            self.reader.parser.packet_class = Asterisk.Util.Packet
+
+        self.channels = weakref.WeakValueDictionary()
+
+        self.response_buffer = {}
+        self.futures = {}
+        self._new_action_ids()
+
+        self.outgoing = ''
+        self.deferred = []
+        self.blocking = 0
+        self.banner = None
+        self.closed = False
+        self.ready = ActionFuture(self, 'Login', None)
+
+
+    def _authenticate(self):
+        'Send our Login action once the server banner has been read.'
+
+        banner = self.banner = self.reader.parser.banner
+        if not banner.startswith(self._AST_BANNER_PREFIX):
+            raise Exception('banner incorrect; got %r, expected one of %r' %\
+                            (banner, self._AST_BANNER_PREFIX))
+
+        self.log.debug('Authenticating as %r/%r.', self.username, self.secret)
+        id, text = self._format_action('Login', self._login_action())
+        future = self.futures[id] = ActionFuture(self, 'Login', id)
+        future.add_callback(self._on_login)
+        self.outgoing += text
+
+
+    def _on_login(self, future):
+        if future.exception is not None:
+            # The connection failed before the PBX answered our Login.
+            self.log.debug('Authentication failed: %s', future.exception)
+            self.handle_close(future.exception)
+            return
+
+        if future.response.get('Response') == 'Error':
+            self.handle_close(AuthenticationFailure('authentication failed.'))
+            return
+
+        self.log.debug('Authenticated as %r.', self.username)
+        self.outgoing += ''.join(self.deferred)
+        del self.deferred[:]
+        self.ready.set_response(future.response)
+
+
+    def _send(self, text):
+        'Queue the formatted request <text> for writing by the loop.'
+
+        if self.closed:
+            raise GoneAwayError('Asterisk Manager connection has gone away.')
+
+        if self.capture is not None:
+            self.capture.sent(text)
+
+        if self.ready.done():
+            self.outgoing += text
+        else:
+            self.deferred.append(text)
+
+
+    def _read_packet(self, discard_events = False):
+        '''
+        Run the loop until a packet is available for this session, and return
+        it. Packets read while a caller is blocked here are left for it
+        rather than being dispatched by the loop.
+        '''
+
+        reader = self.reader
+        self.blocking += 1
+
+        try:
+            started = time.time()
+
+            while True:
+                while not reader.pending():
+                    if self.closed:
+                        raise GoneAwayError('Asterisk Manager connection has gone away.')
+
+                    if self.timeout and time.time() - started > self.timeout:
+                        raise socket.timeout('timed out')
+
+                    poll(self.timeout or 30.0, self.map)
+
+                packet = reader.read_packet()
+                if self.log_packet:
+                    self.log.packet('_read_packet: %r', packet)
+
+                if discard_events and 'Event' in packet:
+                    continue
+
+                return packet
+
+        finally:
+            self.blocking -= 1
+
+
+    def drain(self):
+        'Dispatch packets already read, unless a blocking call is waiting.'
+
+        reader = self.reader
+
+        while not self.blocking and reader.pending():
+            try:
+                self._dispatch_packet(reader.read_packet())
+            except Exception, e:
+                self.log.exception('Error while dispatching packet.')
+
+
+    def handle_read(self):
+        'Called by the loop when our socket is readable.'
+
+        try:
+            self.reader.read_available()
+        except socket.error, e:
+            if e[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        except GoneAwayError, e:
+            self.handle_close(e)
+            return
+
+        if self.banner is None:
+            if self.reader.parser.banner is None:
+                return
+            self._authenticate()
+
+        self.drain()
+
+
+    def handle_write(self):
+        'Called by the loop when our socket is writable.'
+
+        if self.outgoing:
+            sent = self.dispatcher.send(self.outgoing)
+            self.outgoing = self.outgoing[sent:]
+
+
+    def handle_close(self, exception):
+        '''
+        Release our socket and fail every outstanding action with
+        <exception>.
+        '''
+
+        if self.closed:
+            return
+
+        self.log.debug('Connection closed: %s', exception)
+        self.closed = True
+        self.dispatcher.close()
+
+        futures = self.futures.values()
+        self.futures.clear()
+
+        if not self.ready.done():
+            futures.append(self.ready)
+
+        for future in futures:
+            future.set_exception(exception)
+
+
+    def handle_error(self):
+        'Called by the loop when handling our socket raised an exception.'
+
+        self.log.exception('Error on Manager connection.')
+        self.handle_close(GoneAwayError('Asterisk Manager connection failed.'))
+
+
+    def close(self):
+        'Log off and close the connection to the PBX.'
+
+        if self.closed:
+            return
+
+        self.log.debug('Closing down.')
+
+        self._write_action('Logoff')
+        packet = self._read_packet(discard_events = True)
+        if packet.Response != 'Goodbye':
+            raise CommunicationError(packet, 'expected goodbye')
+
+        self.handle_close(GoneAwayError('Asterisk Manager connection closed.'))
+
+
+    def read(self):
+        'Run the loop once; provided for compatibility with BaseManager.'
+
+        poll(0.0, self.map)
+
+
+    def serve_forever(self):
+        'Run the loop until this session is closed.'
+
+        while not self.closed:
+            poll(30.0, self.map)
+
+
+    def wait(self, future):
+        'Run the loop until <future> is resolved.'
+
+        while not future.done():
+            if self.closed:
+                raise GoneAwayError('Asterisk Manager connection has gone away.')
+            poll(30.0, self.map)
+
+
+    def __repr__(self):
+        'Return a string representation of this object.'
+
+        return '<%s.%s connected as %s to %s:%d>' %\
+            ((self.__module__, self.__class__.__name__,
+             self.username) + tuple(self.address))
+
+
+
+
+class AsyncCoreManager(AsyncManager, CoreActions, ZapataActions):
+    '''
+    Asterisk Manager API protocol implementation and core actions for a
+    session driven by an asyncore loop.
+    '''
+
+    pass
+
+
+
+
+def poll(timeout = 0.0, map = None):
+    '''
+    Dispatch packets left over by finished blocking calls, then wait up to
+    <timeout> seconds for activity on the sessions in <map>.
+    '''
+
+    if map is None:
+        map = asyncore.socket_map
+
+    for dispatcher in map.values():
+        if isinstance(dispatcher, _Dispatcher):
+            dispatcher.manager.drain()
+
+    asyncore.poll(timeout, map)
+
+
+
+
+def loop(timeout = 30.0, map = None, count = None):
+    '''
+    Serve every session in <map> until none remain, or for <count> passes if
+    not None.
+    '''
+
+    if map is None:
+        map = asyncore.socket_map
+
+    while map and count != 0:
+        poll(timeout, map)
+        if count is not None:
+            count -= 1
@@ -0,0 +1,421 @@
+'''
+Asterisk/Campaign.py: rate limited bulk call origination.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import socket, threading, time, collections
+import Asterisk, Asterisk.Util, Asterisk.Logging
+from Asterisk.Manager import ConnectionReset
+from Asterisk.Threaded import ThreadedManager
+
+
+
+
+# Number of recent hangups remembered, so a Hangup read before the
+# OriginateResponse naming its channel still ends the call.
+
+_RECENT_HANGUPS = 1024
+
+
+
+
+class CallResult(object):
+    '''
+    Progress and outcome of one call placed by a Campaign. <request> is the
+    mapping of Originate() arguments the call was placed with.
+
+        <id>        ActionID of the Originate request.
+        <sent>      Time the request was written.
+        <queued>    Time the PBX accepted the request.
+        <response>  'Success' or 'Failure' from the OriginateResponse event.
+        <reason>    Asterisk's numeric outcome code from that event.
+        <channel>   Name of the originated channel.
+        <uniqueid>  Unique ID of the originated channel.
+        <answered>  Time the OriginateResponse reported success.
+        <hungup>    Time the originated channel hung up.
+        <cause>     Hangup cause code.
+        <error>     Exception that prevented the call being placed, or
+                    socket.timeout if it never finished.
+        <finished>  Time the call stopped counting against the concurrency
+                    limit.
+    '''
+
+    def __init__(self, request):
+        self.request = request
+        self.id = None
+        self.sent = None
+        self.queued = None
+        self.future = None
+        self.response = None
+        self.reason = None
+        self.channel = None
+        self.uniqueid = None
+        self.answered = None
+        self.hungup = None
+        self.cause = None
+        self.error = None
+        self.finished = None
+
+
+    def __repr__(self):
+        return '<%s.%s %r %s>' % (self.__module__, self.__class__.__name__,
+            self.request.get('channel'), self.outcome())
+
+
+    def outcome(self):
+        "Return one of 'pending', 'error', 'failed', 'answered' or 'completed'."
+
+        if self.error is not None:
+            return 'error'
+        if self.response == 'Failure':
+            return 'failed'
+        if self.hungup is not None:
+            return 'completed'
+        if self.answered is not None:
+            return 'answered'
+        return 'pending'
+
+
+    def duration(self):
+        'Return the seconds from answer to hangup, or None.'
+
+        if self.answered is None or self.hungup is None:
+            return None
+        return self.hungup - self.answered
+
+
+
+
+class Campaign(Asterisk.Logging.InstanceLogger):
+    '''
+    Outbound dialer placing calls from a stream of Originate() requests,
+    no faster than <cps> calls per second and with no more than
+    <max_concurrent> calls in progress at once.
+
+    Requests are sent asynchronously and pipelined, without waiting for each
+    response. The OriginateResponse event carrying each request's ActionID
+    reports whether the call was answered; the call then counts against
+    <max_concurrent> until the Hangup event for its channel arrives.
+
+        campaign = Campaign(manager, cps = 50, max_concurrent = 200)
+        results = campaign.run({ 'channel': 'SIP/' + number,
+            'context': 'outbound', 'extension': 's', 'priority': 1 }
+            for number in numbers)
+        print campaign.stats()
+
+    <manager> must be a blocking BaseManager with CoreActions, which run()
+    drives itself, or a ThreadedManager. It needs 'call' events.
+
+    A ThreadedManager handles OriginateResponse events on its reader thread,
+    but Hangup events pass through its executor, and the default executor
+    drops events when its queue is full. A call whose Hangup is dropped
+    holds its slot until <max_duration>, so give such a manager an executor
+    that does not drop, eg. OrderedExecutor(overflow = 'block'); our own
+    handlers never call the manager, so blocking cannot deadlock them.
+    '''
+
+    def __init__(self, manager, cps = 10.0, max_concurrent = 100,
+            call_timeout = 300.0, track_hangups = True, max_duration = None):
+        '''
+        Place calls through <manager> at no more than <cps> per second, with
+        at most <max_concurrent> in progress. Calls not answered within
+        <call_timeout> seconds of being sent are given up on and finish with
+        socket.timeout, as are answered calls still up <max_duration> seconds
+        after answer, if it is not None. If <track_hangups> is False, answered
+        calls finish at once rather than when they hang up.
+        '''
+
+        if cps <= 0 or max_concurrent < 1:
+            raise ValueError('cps and max_concurrent must be positive.')
+
+        self.manager = manager
+        self.cps = float(cps)
+        self.max_concurrent = max_concurrent
+        self.call_timeout = call_timeout
+        self.max_duration = max_duration
+        self.track_hangups = track_hangups
+        self.threaded = isinstance(manager, ThreadedManager)
+        self.log = self.getLogger()
+
+        if self.threaded and track_hangups and \
+                getattr(manager.executor, 'overflow', None) == 'drop':
+            self.log.warning('%r drops events when busy; calls whose Hangup is '
+                'dropped will count as active until max_duration.', manager)
+
+        self.cond = threading.Condition()
+        self.calls = {}
+        self.uniqueids = {}
+        self.hangups = collections.OrderedDict()
+        self.callback = None
+        self.reset()
+
+        self.events = Asterisk.Util.EventCollection([
+            self.OriginateResponse, self.Hangup ])
+
+
+    def reset(self):
+        'Zero the counters reported by stats().'
+
+        self.started = None
+        self.stopped = None
+        self.counters = dict.fromkeys(('sent', 'queued', 'answered',
+            'failed', 'errors', 'completed', 'timeouts'), 0)
+        self.reasons = {}
+        self.active_peak = 0
+
+
+    def run(self, requests, callback = None):
+        '''
+        Place a call for each mapping of Originate() keyword arguments in the
+        iterable <requests>, which is consumed as calls are placed. Return
+        the list of CallResult objects in request order once every call has
+        finished. <callback>, if given, is called with each CallResult as it
+        finishes.
+        '''
+
+        results = []
+        requests = iter(requests)
+        exhausted = False
+        interval = 1.0 / self.cps
+        next_slot = time.time()
+
+        self.callback = callback
+        self.started = time.time()
+        self.manager.events += self.events
+
+        try:
+            while True:
+                now = time.time()
+
+                while not exhausted and now >= next_slot and \
+                        len(self.calls) < self.max_concurrent:
+                    try:
+                        request = requests.next()
+                    except StopIteration:
+                        exhausted = True
+                        break
+
+                    call = CallResult(request)
+                    results.append(call)
+                    self._originate(call)
+
+                    # Idle time earns no credit, so after a stall calls
+                    # resume at <cps> rather than catching up.
+                    now = time.time()
+                    next_slot = max(next_slot + interval, now)
+
+                if exhausted and not self.calls:
+                    break
+
+                self._sweep(now)
+
+                if exhausted or len(self.calls) >= self.max_concurrent:
+                    wait = 1.0
+                else:
+                    wait = next_slot - now
+                self._pump(max(wait, 0.001))
+        finally:
+            self.manager.events -= self.events
+            self.callback = None
+            self.stopped = time.time()
+
+        return results
+
+
+    def _originate(self, call):
+        'Send the Originate request for <call>.'
+
+        kwargs = dict(call.request)
+        channel = kwargs.pop('channel')
+        kwargs['async'] = True
+
+        # Hold the lock until the call is registered, so its events cannot be
+        # handled on another thread before then.
+        self.cond.acquire()
+        try:
+            call.sent = time.time()
+
+            try:
+                data = self.manager._originate_data(channel, **kwargs)
+                call.future = self.manager.send_action('Originate', data)
+            except (Asterisk.BaseException, socket.error), e:
+                call.error = e
+                self.counters['errors'] += 1
+                self._finish(call)
+                return
+
+            call.id = call.future.id
+            self.calls[call.id] = call
+            self.counters['sent'] += 1
+            self.active_peak = max(self.active_peak, len(self.calls))
+        finally:
+            self.cond.release()
+
+
+    def _sweep(self, now):
+        '''
+        Note the responses read for our Originate requests, and give up on
+        calls unanswered <call_timeout> seconds after they were sent, or up
+        <max_duration> seconds after they were answered.
+        '''
+
+        self.cond.acquire()
+        try:
+            for call in self.calls.values():
+                future = call.future
+
+                if future is not None and future.done():
+                    call.future = None
+                    try:
+                        future.result()
+                        self._queued(call, now)
+                    except Exception, e:
+                        call.error = e
+                        self.counters['errors'] += 1
+                        self._finish(call)
+                        continue
+
+                if call.answered is None:
+                    limit, started = self.call_timeout, call.sent
+                else:
+                    limit, started = self.max_duration, call.answered
+
+                if limit is not None and now - started > limit:
+                    call.error = socket.timeout('call did not finish in time')
+                    self.counters['timeouts'] += 1
+                    self._finish(call)
+        finally:
+            self.cond.release()
+
+
+    def _queued(self, call, now):
+        'Note that the PBX accepted the Originate request for <call>.'
+
+        if call.queued is None:
+            call.queued = now
+            call.future = None
+            self.counters['queued'] += 1
+
+
+    def _finish(self, call):
+        'Stop counting <call> against the concurrency limit.'
+
+        if call.finished is not None:
+            return
+
+        call.finished = time.time()
+        self.calls.pop(call.id, None)
+        self.uniqueids.pop(call.uniqueid, None)
+        self.cond.notifyAll()
+
+        if self.callback is not None:
+            self.callback(call)
+
+
+    def _pump(self, wait):
+        'Handle packets for up to <wait> seconds, or until a call finishes.'
+
+        if self.threaded:
+            self.cond.acquire()
+            try:
+                self.cond.wait(wait)
+            finally:
+                self.cond.release()
+            return
+
+        manager = self.manager
+        manager.sock.settimeout(wait)
+        try:
+            manager.read()
+        except (socket.timeout, ConnectionReset):
+            pass
+        finally:
+            manager.sock.settimeout(manager.timeout)
+
+
+    # Event handlers.
+
+    def OriginateResponse(self, manager, event):
+        self.cond.acquire()
+        try:
+            call = self.calls.get(event.get('ActionID'))
+            if call is None:
+                return
+
+            self._queued(call, time.time())
+            call.response = event.get('Response')
+            call.reason = event.get('Reason')
+            call.channel = str(event.get('Channel'))
+            call.uniqueid = event.get('Uniqueid')
+            self.reasons[call.reason] = self.reasons.get(call.reason, 0) + 1
+
+            if call.response != 'Success':
+                self.counters['failed'] += 1
+                self._finish(call)
+                return
+
+            call.answered = time.time()
+            self.counters['answered'] += 1
+
+            hangup = self.hangups.pop(call.uniqueid, None)
+            if hangup is not None:
+                self._hangup(call, *hangup)
+            elif not self.track_hangups:
+                self._finish(call)
+            elif call.uniqueid:
+                self.uniqueids[call.uniqueid] = call
+        finally:
+            self.cond.release()
+
+    def Hangup(self, manager, event):
+        uniqueid = event.get('Uniqueid')
+        hungup = time.time()
+
+        self.cond.acquire()
+        try:
+            call = self.uniqueids.get(uniqueid)
+            if call is not None:
+                self._hangup(call, hungup, event.get('Cause'))
+            elif self.track_hangups and self.calls:
+                self.hangups[uniqueid] = (hungup, event.get('Cause'))
+                if len(self.hangups) > _RECENT_HANGUPS:
+                    self.hangups.popitem(last = False)
+        finally:
+            self.cond.release()
+
+    def _hangup(self, call, hungup, cause):
+        call.hungup = hungup
+        call.cause = cause
+        self.counters['completed'] += 1
+        self._finish(call)
+
+
+    # Reporting.
+
+    def active(self):
+        'Return the number of calls in progress.'
+        return len(self.calls)
+
+
+    def stats(self):
+        'Return a dict of counters describing the campaign so far.'
+
+        self.cond.acquire()
+        try:
+            stats = dict(self.counters)
+            stats['active'] = len(self.calls)
+            stats['active_peak'] = self.active_peak
+            stats['reasons'] = dict(self.reasons)
+        finally:
+            self.cond.release()
+
+        if self.started is not None:
+            elapsed = (self.stopped or time.time()) - self.started
+        else:
+            elapsed = 0.0
+
+        stats['elapsed'] = elapsed
+        stats['cps'] = elapsed and stats['sent'] / elapsed or 0.0
+        return stats
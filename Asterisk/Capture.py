@@ -0,0 +1,339 @@
+'''
+Asterisk/Capture.py: recording and replay of Manager API sessions.
+
+A capture file starts with an 8 byte magic string and a format version, and
+is followed by one record per packet:
+
+    <timestamp: float64> <direction: uint8> <length: uint32> <packet text>
+
+All integers are little endian. Records are only ever appended, so a capture
+may be read while it is still being written, and a truncated final record is
+ignored. Captures are read through mmap, so large files are not loaded into
+memory.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import os, time, struct, mmap, weakref, collections
+import Asterisk, Asterisk.Util, Asterisk.Protocol
+from Asterisk.Manager import BaseManager, CoreActions, ZapataActions, \
+    GoneAwayError
+
+
+
+
+MAGIC = 'PYASTCAP'
+VERSION = 1
+
+RECEIVED = 0
+SENT = 1
+
+_HEADER = struct.Struct('<8sB')
+_RECORD = struct.Struct('<dBI')
+
+# Number of recorded ActionIDs a ReplayManager remembers the mapping of, so
+# list events arriving after their response are still matched.
+_REPLAY_IDS = 1024
+
+
+
+
+class CaptureError(Asterisk.BaseException):
+    'This exception is raised when a capture file cannot be read.'
+    _prefix = 'capture error'
+
+
+
+
+class CaptureWriter(object):
+    'Append packets to a capture file.'
+
+    def __init__(self, pathname):
+        '''
+        Open capture file <pathname> for appending, creating it if it does not
+        exist.
+        '''
+
+        self.pathname = pathname
+        self.file = open(pathname, 'ab')
+
+        if self.file.tell() == 0:
+            self.file.write(_HEADER.pack(MAGIC, VERSION))
+
+
+    def write(self, data, direction = RECEIVED, timestamp = None):
+        'Append the packet text <data> sent or received at <timestamp>.'
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        self.file.write(_RECORD.pack(timestamp, direction, len(data)) + data)
+
+
+    def received(self, data):
+        'Append the packet text <data> as received now.'
+        self.write(data, RECEIVED)
+
+
+    def sent(self, data):
+        'Append the request text <data> as sent now.'
+        self.write(data, SENT)
+
+
+    def flush(self):
+        self.file.flush()
+
+
+    def close(self):
+        self.file.close()
+
+
+
+
+def _requests(text):
+    'Return a list of (action, id) tuples for the requests in <text>.'
+
+    requests = []
+
+    for block in text.split('\r\n\r\n'):
+        action = id = None
+        for line in block.split('\r\n'):
+            if line.startswith('Action: '):
+                action = line[8:].strip()
+            elif line.startswith('ActionID: '):
+                id = line[10:].strip()
+        if action is not None:
+            requests.append((action.lower(), id))
+
+    return requests
+
+
+
+
+class CaptureReader(object):
+    '''
+    Memory-mapped reader for a capture file. Iterating the reader yields
+    (timestamp, direction, data) tuples in the order they were recorded.
+    '''
+
+    def __init__(self, pathname):
+        self.pathname = pathname
+        self.file = open(pathname, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+
+        if size < _HEADER.size:
+            raise CaptureError('%r is not a capture file.' % (pathname,))
+
+        self.map = mmap.mmap(self.file.fileno(), size, access = mmap.ACCESS_READ)
+        magic, version = _HEADER.unpack_from(self.map, 0)
+
+        if magic != MAGIC:
+            raise CaptureError('%r is not a capture file.' % (pathname,))
+        if version != VERSION:
+            raise CaptureError('%r has unsupported version %d.' % (pathname, version))
+
+
+    def __iter__(self):
+        data = self.map
+        size = len(data)
+        offset = _HEADER.size
+        record_size = _RECORD.size
+        unpack_from = _RECORD.unpack_from
+
+        while offset + record_size <= size:
+            timestamp, direction, length = unpack_from(data, offset)
+            offset += record_size
+
+            if offset + length > size:
+                return
+
+            yield timestamp, direction, data[offset:offset + length]
+            offset += length
+
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+
+
+class ReplayManager(BaseManager):
+    '''
+    BaseManager fed from a capture file instead of a PBX connection. Received
+    packets are read back and dispatched to <events> and on_Event as if they
+    had just arrived. GoneAwayError is raised when the capture is exhausted,
+    as it would be when a real connection closes.
+
+    Requests written by the application are not sent anywhere, but are
+    matched in order against the requests recorded in the capture: when a
+    recorded request for the same action as the application's oldest
+    unanswered one is read, the packets answering it are given the
+    application's ActionID. Actions therefore return their recorded
+    responses so long as the application repeats the recorded session's
+    requests in the same order. Recorded requests the application did not
+    make, such as the original Login, are skipped, and their responses are
+    discarded.
+    '''
+
+    def __init__(self, pathname, speed = 1.0, lazy_events = False,
+            compact_packets = False):
+        '''
+        Replay the capture file <pathname>. Packets are delivered at their
+        recorded pace divided by <speed>, or as fast as possible if <speed>
+        is None. <lazy_events> and <compact_packets> are as for BaseManager.
+        '''
+
+        self.address = (pathname, 0)
+        self.username = 'replay'
+        self.secret = None
+        self.listen_events = True
+        self.event_mask = None
+        self.lazy_events = lazy_events
+        self.compact_packets = compact_packets
+        self.events = Asterisk.Util.EventCollection()
+        self.timeout = None
+        self.speed = speed
+
+        # Configure logging:
+        self.log = self.getLogger()
+        self.cacheLogLevels()
+        self.log.debug('Initialising.')
+
+        self.parser = Asterisk.Protocol.Parser()
+        if lazy_events:
+            self.parser.wants_event = self._wants_event
+        if compact_packets:
+            self.parser.packet_class = Asterisk.Util.Packet
+
+        self.replay = CaptureReader(pathname)
+        self.records = iter(self.replay)
+        self.packets = []
+        self.started = None
+
+        # Our unanswered requests in the order they were written, and the
+        # recorded ActionIDs mapped to ours.
+        self.requests = collections.deque()
+        self.action_ids = collections.OrderedDict()
+
+        self.channels = weakref.WeakValueDictionary()
+        self.response_buffer = {}
+        self.futures = {}
+        self._new_action_ids()
+
+
+    def __repr__(self):
+        return '<%s.%s replaying %r>' %\
+            (self.__module__, self.__class__.__name__, self.address[0])
+
+
+    def _send(self, text):
+        'Queue the requests in <text> to be matched against the capture.'
+
+        if self.capture is not None:
+            self.capture.sent(text)
+
+        self.requests.extend(_requests(text))
+
+
+    def _match(self, data):
+        'Map the ActionIDs of the recorded requests in <data> to our own.'
+
+        requests = self.requests
+        action_ids = self.action_ids
+
+        for action, id in _requests(data):
+            if id is None or not requests or requests[0][0] != action:
+                self.log.debug('Skipping recorded %r request.', action)
+                continue
+
+            action_ids[id] = requests.popleft()[1]
+            if len(action_ids) > _REPLAY_IDS:
+                action_ids.popitem(last = False)
+
+
+    def record(self, writer):
+        '''
+        Append our requests and the packets replayed from now on to the
+        Asterisk.Capture.CaptureWriter <writer>, or stop recording if None.
+        '''
+
+        self.capture = writer
+        self.parser.recorder = writer and writer.received
+
+
+    def _delay(self, timestamp):
+        'Sleep until a packet recorded at <timestamp> is due.'
+
+        now = time.time()
+        if self.started is None:
+            self.started = (now, timestamp)
+            return
+
+        wall, first = self.started
+        delay = wall + (timestamp - first) / self.speed - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+    def _read_packet(self, discard_events = False):
+        'Return the next received packet from the capture.'
+
+        while True:
+            while not self.packets:
+                for timestamp, direction, data in self.records:
+                    if direction == RECEIVED:
+                        break
+                    self._match(data)
+                else:
+                    raise GoneAwayError('end of capture %r.' % (self.address[0],))
+
+                if self.speed:
+                    self._delay(timestamp)
+
+                self.packets = self.parser.feed(data)
+                self.packets.reverse()
+
+            packet = self.packets.pop()
+
+            if discard_events and 'Event' in packet:
+                continue
+
+            if 'ActionID' in packet:
+                id = self.action_ids.get(packet['ActionID'])
+                if id is not None:
+                    packet['ActionID'] = id
+                elif 'Event' not in packet:
+                    # A response to a recorded request we did not repeat.
+                    continue
+
+            return packet
+
+
+    def instrument(self, metrics):
+        'Take measurements of the replayed session into <metrics>.'
+
+        self.metrics = metrics
+        self.events.metrics = metrics
+
+
+    def read(self):
+        'Dispatch the next packet from the capture.'
+        self._dispatch_packet(self._read_packet())
+
+
+    def close(self):
+        'Close the capture file.'
+        self.replay.close()
+
+
+
+
+class ReplayCoreManager(ReplayManager, CoreActions, ZapataActions):
+    '''
+    ReplayManager with the core actions, for replaying captures into code
+    written against CoreManager.
+    '''
+
+    pass
@@ -0,0 +1,201 @@
+'''
+Asterisk/Cluster.py: run Manager API actions on many PBXes at once.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import socket, threading, time
+import Asterisk, Asterisk.Logging
+from Asterisk import Config, Manager, Pool
+
+
+
+
+class NodeResult(object):
+    '''
+    Outcome of an action on one PBX: <result> if it succeeded, otherwise
+    <error>, and the <seconds> it took including acquiring a session.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.result = None
+        self.error = None
+        self.seconds = None
+
+
+    def ok(self):
+        'Return truth if the action completed without error.'
+        return self.error is None and self.seconds is not None
+
+
+    def __repr__(self):
+        if self.error is not None:
+            outcome = 'failed: %s' % (self.error,)
+        else:
+            outcome = 'ok'
+        return '<%s.%s %r %s in %.3fs>' %\
+            (self.__module__, self.__class__.__name__, self.name, outcome,
+             self.seconds or 0.0)
+
+
+
+
+class ClusterResult(dict):
+    'Mapping of connection profile name to NodeResult for one action.'
+
+    def results(self):
+        'Return a dict of the results of nodes that succeeded, by name.'
+        return dict([ (n, r.result) for (n, r) in self.iteritems() if r.ok() ])
+
+
+    def errors(self):
+        'Return a dict of the errors raised by nodes that failed, by name.'
+        return dict([ (n, r.error) for (n, r) in self.iteritems() if not r.ok() ])
+
+
+    def merged(self):
+        '''
+        Merge the results of the nodes that succeeded. Dict results, such as
+        from Status(), are merged into one dict keyed by (name, key) tuples;
+        list results, such as from Command(), into one list of (name, item)
+        tuples. Other results are returned as a dict keyed by name.
+        '''
+
+        results = self.results()
+        values = results.values()
+
+        if values and not [ v for v in values if not isinstance(v, dict) ]:
+            merged = {}
+            for name, result in results.iteritems():
+                for key, value in result.iteritems():
+                    merged[name, key] = value
+            return merged
+
+        if values and not [ v for v in values if not isinstance(v, list) ]:
+            merged = []
+            for name in sorted(results):
+                merged.extend([ (name, item) for item in results[name] ])
+            return merged
+
+        return results
+
+
+
+
+class Cluster(Asterisk.Logging.InstanceLogger):
+    '''
+    Client for a fleet of PBXes, each described by a connection profile in
+    the configuration file. Sessions are kept in a ManagerPool, and actions
+    are run on every PBX at once, one thread per PBX:
+
+        cluster = Cluster()
+        result = cluster.Status()
+        channels = result.merged()
+        failed = result.errors()
+
+    Any action method of <manager_class> may be called on the cluster this
+    way, and returns a ClusterResult.
+    '''
+
+    def __init__(self, config = None, connections = None,
+            manager_class = Manager.CoreManager, timeout = 10.0,
+            max_size = 2):
+        '''
+        Serve the connection profiles named in <connections>, or every
+        profile in the Config instance <config> if None. A new Config is read
+        if <config> is None. Actions not completed on a PBX within <timeout>
+        seconds are reported as failed for that PBX. At most <max_size>
+        sessions are kept per PBX.
+        '''
+
+        if config is None:
+            config = Config.Config()
+
+        if connections is None:
+            connections = config.get_connection_names()
+
+        self.config = config
+        self.connections = list(connections)
+        self.manager_class = manager_class
+        self.timeout = timeout
+        self.pool = Pool.ManagerPool(config, manager_class, max_size = max_size,
+            timeout = timeout)
+        self.lock = threading.Lock()
+        self.log = self.getLogger()
+
+
+    def _call(self, node, method, args, kwargs):
+        'Thread body: run <method> on a session for <node>.'
+
+        started = time.time()
+        result = error = None
+
+        try:
+            with self.pool.session(node.name, self.timeout) as manager:
+                result = getattr(manager, method)(*args, **kwargs)
+        except Exception, e:
+            self.log.debug('%s on %r failed: %s', method, node.name, e)
+            error = e
+
+        self._finish(node, result, error, time.time() - started)
+
+
+    def _finish(self, node, result, error, seconds):
+        'Record the outcome for <node>, unless it has already timed out.'
+
+        self.lock.acquire()
+        try:
+            if node.seconds is None:
+                node.result = result
+                node.error = error
+                node.seconds = seconds
+        finally:
+            self.lock.release()
+
+
+    def run(self, method, *args, **kwargs):
+        '''
+        Call the Manager method named <method> with *<args> and **<kwargs> on
+        every PBX concurrently, and return a ClusterResult.
+        '''
+
+        result = ClusterResult()
+        threads = []
+
+        for name in self.connections:
+            node = result[name] = NodeResult(name)
+            thread = threading.Thread(target = self._call,
+                args = (node, method, args, kwargs),
+                name = 'Asterisk cluster %s' % (name,))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append((node, thread))
+
+        deadline = time.time() + self.timeout
+
+        for node, thread in threads:
+            thread.join(max(0.0, deadline - time.time()))
+            if thread.isAlive():
+                self._finish(node, None, socket.timeout('timed out'), self.timeout)
+
+        return result
+
+
+    def __getattr__(self, name):
+        'Return a function running action method <name> on every PBX.'
+
+        if name[:1].isupper() and hasattr(self.manager_class, name):
+            def action(*args, **kwargs):
+                return self.run(name, *args, **kwargs)
+
+            action.__name__ = name
+            return action
+
+        raise AttributeError(name)
+
+
+    def close(self):
+        'Close every idle session.'
+        self.pool.close()
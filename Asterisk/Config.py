@@ -72,6 +72,14 @@ class Config(object):
         self.refresh()
 
 
+    def get_connection_names(self):
+        'Return the names of every connection profile, in file order.'
+
+        prefix = 'connection: '
+        return [ section[len(prefix):] for section in self.conf.sections()
+            if section.startswith(prefix) ]
+
+
     def get_connection(self, connection = None):
         '''
         Return an (address, username, secret) argument tuple, suitable for
@@ -0,0 +1,325 @@
+'''
+Asterisk/Correlator.py: group channel events into calls as they happen.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import threading, time, collections
+import Asterisk.Util, Asterisk.Logging
+
+
+
+
+class Leg(object):
+    '''
+    One channel taking part in a call.
+
+        <uniqueid>  The channel's Unique ID.
+        <channel>   The channel's name.
+        <callerid>  Caller ID number of the channel, if known.
+        <created>   Time the channel was first seen.
+        <answered>  Time the channel was answered, or None.
+        <hungup>    Time the channel hung up, or None.
+        <cause>     Hangup cause code, or None.
+        <cause_txt> Hangup cause description, or None.
+    '''
+
+    __slots__ = ('uniqueid', 'channel', 'callerid', 'created', 'answered',
+        'hungup', 'cause', 'cause_txt', 'call')
+
+    def __init__(self, uniqueid, channel, created):
+        self.uniqueid = uniqueid
+        self.channel = channel
+        self.callerid = None
+        self.created = created
+        self.answered = None
+        self.hungup = None
+        self.cause = None
+        self.cause_txt = None
+        self.call = None
+
+
+    def __repr__(self):
+        return '<%s.%s %s %r>' % (self.__module__, self.__class__.__name__,
+            self.uniqueid, self.channel)
+
+
+
+
+class Call(object):
+    '''
+    A group of legs joined by Dial, Link or Bridge events.
+
+        <id>        Unique ID of the first leg seen.
+        <legs>      List of Leg objects, in the order they were seen.
+        <links>     List of (time, uniqueid1, uniqueid2) tuples for each time
+                    two legs were bridged.
+        <timeline>  List of (time, event name, uniqueid) tuples, holding at
+                    most the correlator's <max_timeline> entries.
+        <started>   Time the first leg was seen.
+        <ended>     Time the last leg hung up, or None.
+        <active>    Number of legs not yet hung up.
+    '''
+
+    def __init__(self, id, started):
+        self.id = id
+        self.legs = []
+        self.links = []
+        self.timeline = []
+        self.started = started
+        self.ended = None
+        self.active = 0
+        self.last_seen = started
+
+
+    def __repr__(self):
+        return '<%s.%s %s, %d legs, %d active>' % (self.__module__,
+            self.__class__.__name__, self.id, len(self.legs), self.active)
+
+
+    def answered(self):
+        'Return the time the first leg was answered, or None.'
+
+        times = [ leg.answered for leg in self.legs if leg.answered is not None ]
+        return times and min(times) or None
+
+
+    def duration(self):
+        'Return the seconds from the first answer to the end of the call, or None.'
+
+        answered = self.answered()
+        if answered is None or self.ended is None:
+            return None
+        return self.ended - answered
+
+
+
+
+class CallCorrelator(Asterisk.Logging.InstanceLogger):
+    '''
+    Streaming correlator grouping Newchannel, Newstate, Dial, Link, Bridge
+    and Hangup events into Call objects with linked legs, as described in
+    doc/event-handling.txt.
+
+    Legs and calls are indexed by Unique ID, so each event costs a constant
+    number of dictionary operations; when an event joins two calls, the legs
+    of the smaller are moved into the larger. When the last leg of a call
+    hangs up, the call is dropped from our indexes and 'CallCompleted' is
+    fired through <completed>, passing the correlator and the Call.
+
+    Memory is bounded: calls with no events for <ttl> seconds, such as those
+    whose Hangup was missed, and the least recently active calls beyond
+    <max_calls>, are dropped and fired as 'CallExpired' instead.
+    '''
+
+    def __init__(self, manager, ttl = 7200.0, max_calls = 100000,
+            max_timeline = 64):
+        '''
+        Correlate the events of BaseManager <manager>, registering our event
+        handlers with it. Calls idle for <ttl> seconds are expired, at most
+        <max_calls> calls are tracked, and each call's timeline holds at most
+        <max_timeline> entries.
+        '''
+
+        self.manager = manager
+        self.ttl = ttl
+        self.max_calls = max_calls
+        self.max_timeline = max_timeline
+        self.log = self.getLogger()
+
+        self.lock = threading.Lock()
+        self.legs = {}
+        self.calls = collections.OrderedDict()
+        self.completed = Asterisk.Util.EventCollection()
+
+        self.events = Asterisk.Util.EventCollection([
+            self.Newchannel, self.Newstate, self.Dial, self.Link, self.Bridge,
+            self.Hangup ])
+
+        manager.events += self.events
+
+
+    def close(self):
+        'Unregister our event handlers from the manager.'
+        self.manager.events -= self.events
+
+
+    def _leg(self, uniqueid, channel, now):
+        'Return the leg <uniqueid>, starting a call for it if it is new.'
+
+        leg = self.legs.get(uniqueid)
+
+        if leg is None:
+            leg = self.legs[uniqueid] = Leg(uniqueid, channel, now)
+            call = Call(uniqueid, now)
+            call.legs.append(leg)
+            call.active = 1
+            leg.call = call
+            self.calls[uniqueid] = call
+
+        return leg
+
+
+    def _touch(self, call, now, name, uniqueid):
+        'Record event <name> for <uniqueid> on <call>, marking it recently active.'
+
+        if len(call.timeline) < self.max_timeline:
+            call.timeline.append((now, name, uniqueid))
+
+        call.last_seen = now
+        del self.calls[call.id]
+        self.calls[call.id] = call
+
+
+    def _join(self, one, two):
+        'Merge the calls of legs <one> and <two>, returning the merged call.'
+
+        call, other = one.call, two.call
+        if call is other:
+            return call
+
+        if len(other.legs) > len(call.legs):
+            call, other = other, call
+
+        for leg in other.legs:
+            leg.call = call
+
+        call.legs.extend(other.legs)
+        call.links.extend(other.links)
+        call.timeline.extend(other.timeline[:self.max_timeline - len(call.timeline)])
+        call.timeline.sort()
+        call.started = min(call.started, other.started)
+        call.active += other.active
+        del self.calls[other.id]
+        return call
+
+
+    def _expire(self, now, finished):
+        'Drop calls idle for <ttl> seconds, and the oldest beyond <max_calls>.'
+
+        calls = self.calls
+        deadline = now - self.ttl
+
+        while calls:
+            id, call = next(calls.iteritems())
+            if call.last_seen >= deadline and len(calls) <= self.max_calls:
+                break
+
+            del calls[id]
+            for leg in call.legs:
+                self.legs.pop(leg.uniqueid, None)
+            finished.append(('CallExpired', call))
+
+
+    def _handle(self, update):
+        '''
+        Call <update>(now, finished) under our lock, then fire notifications
+        for the calls it added to <finished>.
+        '''
+
+        now = time.time()
+        finished = []
+
+        self.lock.acquire()
+        try:
+            update(now, finished)
+            self._expire(now, finished)
+        finally:
+            self.lock.release()
+
+        for name, call in finished:
+            self.completed.fire(name, self, call)
+
+
+    # Event handlers.
+
+    def Newchannel(self, manager, event):
+        def update(now, finished):
+            leg = self._leg(event.Uniqueid, str(event.Channel), now)
+            leg.callerid = event.get('CallerIDNum') or event.get('CallerID')
+            self._touch(leg.call, now, 'Newchannel', leg.uniqueid)
+
+        self._handle(update)
+
+    def Newstate(self, manager, event):
+        state = event.get('ChannelStateDesc') or event.get('State')
+
+        def update(now, finished):
+            leg = self.legs.get(event.get('Uniqueid'))
+            if leg is None:
+                return
+            if state == 'Up' and leg.answered is None:
+                leg.answered = now
+            self._touch(leg.call, now, 'Newstate', leg.uniqueid)
+
+        self._handle(update)
+
+    def Dial(self, manager, event):
+        if event.get('SubEvent', 'Begin') != 'Begin':
+            return
+
+        source = event.get('SrcUniqueID') or event.get('UniqueID')
+        dest = event.get('DestUniqueID')
+        if not (source and dest):
+            return
+
+        def update(now, finished):
+            one = self._leg(source, str(event.get('Source') or event.get('Channel')), now)
+            two = self._leg(dest, str(event.get('Destination')), now)
+            call = self._join(one, two)
+            self._touch(call, now, 'Dial', dest)
+
+        self._handle(update)
+
+    def Link(self, manager, event):
+        def update(now, finished):
+            one = self._leg(event.Uniqueid1, str(event.Channel1), now)
+            two = self._leg(event.Uniqueid2, str(event.Channel2), now)
+            call = self._join(one, two)
+            call.links.append((now, one.uniqueid, two.uniqueid))
+            self._touch(call, now, 'Link', one.uniqueid)
+
+        self._handle(update)
+
+    def Bridge(self, manager, event):
+        if event.get('Bridgestate', 'Link') == 'Link':
+            self.Link(manager, event)
+
+    def Hangup(self, manager, event):
+        def update(now, finished):
+            leg = self.legs.get(event.get('Uniqueid'))
+            if leg is None or leg.hungup is not None:
+                return
+
+            leg.hungup = now
+            leg.cause = event.get('Cause')
+            leg.cause_txt = event.get('Cause-txt')
+
+            call = leg.call
+            call.active -= 1
+            self._touch(call, now, 'Hangup', leg.uniqueid)
+
+            if not call.active:
+                call.ended = now
+                del self.calls[call.id]
+                for other in call.legs:
+                    self.legs.pop(other.uniqueid, None)
+                finished.append(('CallCompleted', call))
+
+        self._handle(update)
+
+
+    # Queries.
+
+    def __len__(self):
+        return len(self.calls)
+
+    def __iter__(self):
+        return self.calls.itervalues()
+
+    def call(self, uniqueid):
+        'Return the call that leg <uniqueid> belongs to, or None.'
+
+        leg = self.legs.get(uniqueid)
+        return leg and leg.call
@@ -0,0 +1,205 @@
+'''
+Asterisk/Executor.py: worker pools for running event handlers off the
+socket-reading path.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import threading, time, Queue
+import Asterisk, Asterisk.Logging
+
+
+
+
+class ExecutorFull(Asterisk.BaseException):
+    'This exception is raised when a call is submitted to a full executor.'
+    _prefix = 'executor full'
+
+
+
+
+def event_key(args):
+    '''
+    Return the ordering key for a call whose last argument is an event: its
+    Uniqueid, or its channel name if it has none. Events for the same call
+    leg therefore always run in the order they were received.
+    '''
+
+    if args and hasattr(args[-1], 'get'):
+        event = args[-1]
+        for name in ('Uniqueid', 'Uniqueid1', 'Channel', 'Channel1'):
+            value = event.get(name)
+            if value is not None:
+                return str(value)
+
+
+
+
+class OrderedExecutor(Asterisk.Logging.InstanceLogger):
+    '''
+    Pool of worker threads, each with its own bounded queue. Calls with the
+    same ordering key always go to the same worker, so they run in order,
+    while calls for different keys run concurrently. Calls without a key go
+    to the first worker.
+
+    Handlers receive live objects such as the Manager, so the pool uses
+    threads rather than processes.
+    '''
+
+    def __init__(self, workers = 4, max_queue = 10000, key = event_key,
+            overflow = 'block', metrics = None):
+        '''
+        Start <workers> worker threads, each queueing up to <max_queue> calls.
+        <key> is called with the argument tuple of each submitted call and
+        returns its ordering key.
+
+        When a worker's queue is full, submit() waits for space if <overflow>
+        is 'block', discards the call if it is 'drop', or raises ExecutorFull
+        if it is 'raise'. Blocking preserves every event but stalls the
+        submitter; dropping keeps the socket drained under overload.
+
+        If <metrics> is an Asterisk.Metrics.Metrics instance, queue depth,
+        queueing delay and time spent blocked are recorded to it.
+        '''
+
+        if overflow not in ('block', 'drop', 'raise'):
+            raise ValueError('overflow must be block, drop or raise.')
+
+        self.key = key
+        self.overflow = overflow
+        self.metrics = metrics
+        self.log = self.getLogger()
+        self.lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.errors = 0
+        self.max_depth = 0
+
+        self.queues = []
+        self.threads = []
+
+        for nr in xrange(workers):
+            queue = Queue.Queue(max_queue)
+            thread = threading.Thread(target = self._run, args = (queue,),
+                name = 'Asterisk executor %d' % (nr,))
+            thread.setDaemon(True)
+            self.queues.append(queue)
+            self.threads.append(thread)
+            thread.start()
+
+
+    def submit(self, func, *args):
+        'Queue the call func(*args) on the worker for its ordering key.'
+
+        key = self.key(args)
+        queues = self.queues
+
+        if key is None or len(queues) == 1:
+            queue = queues[0]
+        else:
+            queue = queues[hash(key) % len(queues)]
+
+        item = (func, args, time.time())
+        self.submitted += 1
+
+        try:
+            queue.put_nowait(item)
+        except Queue.Full:
+            self._overflow(queue, item)
+
+        depth = queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.gauge('executor.depth', depth)
+
+
+    def _overflow(self, queue, item):
+        'Apply our overflow policy to <item>, which did not fit in <queue>.'
+
+        if self.overflow == 'drop':
+            self.dropped += 1
+            if self.metrics is not None:
+                self.metrics.count('executor.dropped')
+            self.log.debug('Queue full, dropping call to %r.', item[0])
+            return
+
+        if self.overflow == 'raise':
+            self.submitted -= 1
+            raise ExecutorFull('no room to queue call to %r.' % (item[0],))
+
+        self.blocked += 1
+        started = time.time()
+        queue.put(item)
+
+        if self.metrics is not None:
+            self.metrics.observe('executor.blocked', time.time() - started)
+
+
+    def _run(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+
+            func, args, queued = item
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.observe('executor.wait', time.time() - queued)
+
+            try:
+                func(*args)
+                failed = 0
+            except Exception, e:
+                failed = 1
+                self.log.exception('Error in %r.', func)
+
+            self.lock.acquire()
+            try:
+                self.completed += 1
+                self.errors += failed
+            finally:
+                self.lock.release()
+
+
+    def pending(self):
+        'Return the number of calls waiting to run.'
+        return sum([ queue.qsize() for queue in self.queues ])
+
+
+    def stats(self):
+        'Return a dict of counters describing the load on the pool.'
+
+        return {
+            'workers': len(self.threads),
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'dropped': self.dropped,
+            'blocked': self.blocked,
+            'errors': self.errors,
+            'pending': self.pending(),
+            'depths': [ queue.qsize() for queue in self.queues ],
+            'max_depth': self.max_depth,
+        }
+
+
+    def shutdown(self, wait = True):
+        '''
+        Stop the workers once their queued calls have run, waiting for them
+        to finish if <wait> is True.
+        '''
+
+        for queue in self.queues:
+            queue.put(None)
+
+        if wait:
+            current = threading.currentThread()
+            for thread in self.threads:
+                if thread is not current:
+                    thread.join()
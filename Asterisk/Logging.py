@@ -5,7 +5,7 @@ Asterisk/Logging.py: extensions to the Python 2.3 logging module.
 __author__ = 'David Wilson'
 __Id__ = '$Id$'
 
-import logging
+import logging, weakref
 
 
 
@@ -56,9 +56,32 @@ logging.setLoggerClass(AsteriskLogger)
 
 
 
+# Instances that have cached their logging decisions, refreshed by
+# reconfigure().
+
+_cached = weakref.WeakSet()
+
+
+
+
+def reconfigure():
+    '''
+    Refresh the logging decisions cached by cacheLogLevels(). Call this after
+    changing logger levels or calling logging.disable() at runtime.
+    '''
+
+    for instance in list(_cached):
+        instance.cacheLogLevels()
+
+
+
+
 # Per-instance logging mix-in.
 
 class InstanceLogger(object):
+    # Whether our logger currently passes each level; see cacheLogLevels().
+    log_debug = log_packet = log_io = True
+
     def getLoggerName(self):
         '''
         Return the name where log messages for this instance is sent.
@@ -74,3 +97,17 @@ class InstanceLogger(object):
         '''
 
         return logging.getLogger(self.getLoggerName())
+
+
+    def cacheLogLevels(self):
+        '''
+        Record in <log_debug>, <log_packet> and <log_io> whether <log> passes
+        messages at each level, so hot paths may test a flag instead of
+        calling the logger. The flags are refreshed by reconfigure().
+        '''
+
+        log = self.log
+        self.log_debug = log.isEnabledFor(logging.DEBUG)
+        self.log_packet = log.isEnabledFor(logging.PACKET)
+        self.log_io = log.isEnabledFor(logging.IO)
+        _cached.add(self)
@@ -5,9 +5,10 @@ Asterisk Manager and Channel objects.
 __author__ = 'David Wilson'
 __id__ = '$Id$'
 
-import socket, time, logging, errno, os, re, datetime
+import socket, time, logging, errno, os, re, collections, weakref, itertools
+import random
 from new import instancemethod
-import Asterisk, Asterisk.Util, Asterisk.Logging
+import Asterisk, Asterisk.Util, Asterisk.Logging, Asterisk.Protocol
 
 
 
@@ -39,6 +40,13 @@ class GoneAwayError(BaseException):
     'This exception is raised when the Manager connection becomes closed.'
 
 
+class ConnectionReset(GoneAwayError):
+    '''
+    This exception is raised for actions in flight when the Manager connection
+    was lost and has been re-established.
+    '''
+
+
 class InternalError(BaseException):
     'This exception is raised when an error occurs within a Manager object.'
     _prefix = 'py-Asterisk internal error'
@@ -60,6 +68,201 @@ class PermissionDenied(BaseException):
 
 
 
+# ActionIDs are "<host>-<pid>-<connection>-<sequence>", so every connection
+# made by every client sharing a PBX uses its own ActionID namespace.
+
+_HOSTNAME = socket.gethostname().split('.')[0]
+_connection_numbers = itertools.count(1)
+
+# Parsers for the CLI output scraped by ExtensionStates, MeetMe and MeetMeList.
+
+_HINT_RE = re.compile(r'\s+(\d+)@(\S+).+State:(\S+)')
+_MEETME_RE = re.compile(r'^(?P<confnum>\d+)\s+(?P<parties>\d+)\s+(?P<marked>\S+)\s+(?P<activity>\S+)\s+(?P<creation>\S+)')
+_MEETME_USER_RE = re.compile(r'^User #: (?P<usernum>\d+)\s+(?P<callerid>.+)\s+Channel: (?P<channel>\S+)\s+\((?P<monitor>.+)\)\s+(?P<duration>\S+)')
+
+
+
+
+class PacketReader(object):
+    '''
+    Buffered packet reader for a Manager API socket. Data is pulled from the
+    socket in large blocks using recv_into() on a reusable buffer, and every
+    complete packet found in a block is parsed at once by an
+    Asterisk.Protocol.Parser, so a busy event stream costs one system call
+    per block rather than one per header line.
+    '''
+
+    def __init__(self, sock, timeout = None, bufsize = 65536):
+        '''
+        Initialise a reader for the connected socket <sock>. <timeout> bounds
+        the time spent waiting for the end of a "Response: Follows" packet.
+        '''
+
+        self.sock = sock
+        self.timeout = timeout
+        self.buffer = bytearray(bufsize)
+        self.view = memoryview(self.buffer)
+        self.parser = Asterisk.Protocol.Parser(banner = True)
+        self.packets = collections.deque()
+        self.follows_started = None
+        self.metrics = None
+
+
+    def read_available(self):
+        'Read one block from the socket and parse the packets it completes.'
+
+        while True:
+            try:
+                count = self.sock.recv_into(self.buffer)
+                break
+            except socket.error, e:
+                if e[0] != errno.EINTR:
+                    raise
+
+        if not count:
+            raise GoneAwayError('Asterisk Manager connection has gone away.')
+
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.time()
+
+        try:
+            packets = self.parser.feed(self.view[:count].tobytes())
+        except Asterisk.Protocol.ParseError, e:
+            # Keep the good packets from the block for the next read.
+            self.packets.extend(e.packets)
+            raise InternalError('Malformed packet detected: %s' % (e._error,))
+
+        if metrics is not None:
+            metrics.packets_read(count, len(packets), time.time() - started)
+
+        self.packets.extend(packets)
+
+        if not self.parser.follows:
+            self.follows_started = None
+        elif self.follows_started is None:
+            self.follows_started = time.time()
+
+
+    def read_banner(self):
+        'Return the server banner line, reading it if necessary.'
+
+        while self.parser.banner is None:
+            self.read_available()
+
+        return self.parser.banner
+
+
+    def read_packet(self):
+        'Return the next packet, reading from the socket only if necessary.'
+
+        packets = self.packets
+
+        while not packets:
+            if self.follows_started is not None and self.timeout and \
+                    time.time() - self.follows_started > self.timeout:
+                raise CommunicationError(self.parser.data, 'expected --END COMMAND--')
+
+            self.read_available()
+
+        return packets.popleft()
+
+
+    def pending(self):
+        'Return truth if complete packets are waiting to be read.'
+
+        return bool(self.packets)
+
+
+
+
+class ActionFuture(object):
+    '''
+    Handle for an action sent by BaseManager.send_action(), resolved when the
+    response carrying its ActionID is read from the Manager API.
+    '''
+
+    def __init__(self, manager, action, id):
+        '''
+        Initialise a handle for the request <action> sent with action
+        identifier <id> via BaseManager <manager>.
+        '''
+
+        self.manager = manager
+        self.action = action
+        self.id = id
+        self.response = None
+        self.exception = None
+        self.translated = False
+        self.callbacks = []
+
+
+    def __repr__(self):
+        return '<%s.%s for %s action %r>' %\
+            (self.__class__.__module__, self.__class__.__name__,
+             self.action, self.id)
+
+
+    def add_callback(self, callback):
+        '''
+        Call <callback> with this future once it is resolved, immediately if
+        it already is.
+        '''
+
+        if self.done():
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+
+    def done(self):
+        'Return truth if the response to our action has been received.'
+        return self.response is not None or self.exception is not None
+
+
+    def _resolve(self):
+        for callback in self.callbacks:
+            callback(self)
+        del self.callbacks[:]
+
+
+    def set_response(self, packet):
+        'Resolve the future with the response <packet>.'
+
+        self.response = packet
+        self._resolve()
+
+
+    def set_exception(self, exception):
+        'Resolve the future with <exception>, raised by result().'
+
+        self.exception = exception
+        self._resolve()
+
+
+    def result(self):
+        '''
+        Wait for the response to our action and return it, raising
+        ActionFailed or PermissionDenied if the PBX reports failure.
+        '''
+
+        if not self.done():
+            self.manager.wait(self)
+
+        if self.exception is None and not self.translated:
+            self.translated = True
+            try:
+                self.response = self.manager._translate_response(self.response)
+            except BaseException, e:
+                self.exception = e
+
+        if self.exception is not None:
+            raise self.exception
+        return self.response
+
+
+
+
 class BaseChannel(Asterisk.Logging.InstanceLogger):
     '''
     Represents a living Asterisk channel, with shortcut methods for operating
@@ -75,7 +278,11 @@ class BaseChannel(Asterisk.Logging.InstanceLogger):
 
         self.manager = manager
         self.id = id
-        self.log = self.getLogger()
+
+    @property
+    def log(self):
+        'Logger for this channel, only looked up when used.'
+        return self.getLogger()
 
     def __eq__(self, other):
         'Return truth if <other> is equal to this object.'
@@ -110,6 +317,13 @@ class BaseChannel(Asterisk.Logging.InstanceLogger):
             return self.manager.Getvar(self, variable)
         return self.manager.Getvar(self, variable, default)
 
+    def Getvars(self, variables, default = None):
+        '''
+        Return a dict of the values of this channel's <variables>, mapping
+        those that are not set to <default>.
+        '''
+        return self.manager.Getvars(self, variables, default)
+
     def Hangup(self):
         'Hangup this channel.'
         return self.manager.Hangup(self)
@@ -133,8 +347,19 @@ class BaseChannel(Asterisk.Logging.InstanceLogger):
         'Set the <variable> in this channel to <value>.'
         return self.manager.Setvar(self, variable, value)
 
+    def Setvars(self, mapping):
+        'Set the variables in this channel to the values in <mapping>.'
+        return self.manager.Setvars(self, mapping)
+
     def Status(self):
-        'Return the Status() dict for this channel (wasteful!).'
+        '''
+        Return the Status() dict for this channel, from the manager's
+        ChannelRegistry if it has one (otherwise wasteful!).
+        '''
+
+        registry = self.manager.channel_registry
+        if registry is not None:
+            return registry[self]
         return self.manager.Status()[self]
 
     def StopMonitor(self):
@@ -181,53 +406,230 @@ class BaseManager(Asterisk.Logging.InstanceLogger):
 
     _AST_BANNER_PREFIX = 'Asterisk Call Manager'
 
+    # Asterisk.State.ChannelRegistry tracking our channels, if any.
+    channel_registry = None
+
+    # Asterisk.State.VariableCache holding channel variables we have read,
+    # if any.
+    variable_cache = None
+
+    # Asterisk.Capture.CaptureWriter recording our session, if any.
+    capture = None
+
+    # Asterisk.Metrics.Metrics measuring our session, if any.
+    metrics = None
+
+    # Executor, such as Asterisk.Executor.OrderedExecutor, running on_Event
+    # for unsolicited events; if None, they are handled as they are read.
+    # Only ThreadedManager may send actions from handlers run this way: a
+    # plain BaseManager's socket is read by whichever thread calls it, so
+    # handlers on worker threads must not call the manager.
+    executor = None
+
+    # Reconnection policy; see reconnect(). Delays are in seconds, and
+    # reconnect_attempts is None to keep trying forever.
+    auto_reconnect = False
+    reconnect_delay = 0.5
+    reconnect_max_delay = 30.0
+    reconnect_attempts = None
+    reconnecting = False
+
 
     def __init__(self, address, username, secret, listen_events=True,
-            timeout=None):
+            timeout=None, event_mask=None, lazy_events=False,
+            compact_packets=False, reconnect=False):
         '''
         Provide communication methods for the PBX instance running at
         <address>. Authenticate using <username> and <secret>. Receive event
         information from the Manager API if <listen_events> is True.
+
+        If <event_mask> is a list of event categories (eg. [ 'call', 'agent' ]),
+        ask the PBX to send only events in those categories. If <lazy_events>
+        is True, events that no handler in <events> is subscribed to are
+        dropped as they are read, without being parsed or passed to on_Event.
+        If <compact_packets> is True, packets are read as Asterisk.Util.Packet
+        objects rather than AttributeDicts, which use much less memory. If
+        <reconnect> is True, a lost connection is re-established
+        automatically, and the first connection is retried in the same way
+        until it succeeds or <reconnect_attempts> attempts fail; see
+        reconnect().
         '''
 
         self.address = address
         self.username = username
         self.secret = secret
         self.listen_events = listen_events
+        self.event_mask = event_mask
+        self.lazy_events = lazy_events
+        self.compact_packets = compact_packets
+        self.auto_reconnect = reconnect
         self.events = Asterisk.Util.EventCollection()
         self.timeout = timeout
 
         # Configure logging:
         self.log = self.getLogger()
+        self.cacheLogLevels()
         self.log.debug('Initialising.')
 
+        self.channels = weakref.WeakValueDictionary()
+        self.response_buffer = {}
+        self.futures = {}
+
+        if self.auto_reconnect:
+            self._establish()
+        else:
+            self._connect()
+            self._new_action_ids()
+            self._authenticate()
+
+
+    def _connect(self):
+        'Connect to the PBX and prepare a PacketReader for the socket.'
+
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(self.timeout)
-        sock.connect(address)
 
-        self.file = sock.makefile('r+', 0) # line buffered.
-        self.fileno = self.file.fileno
+        try:
+            sock.connect(self.address)
+        except:
+            sock.close()
+            raise
+
+        self.sock = sock
+        self.fileno = sock.fileno
+        self.reader = PacketReader(sock, self.timeout)
+        self.reader.metrics = self.metrics
+
+        if self.lazy_events:
+            self.reader.parser.wants_event = self._wants_event
+        if self.compact_packets:
+            self.reader.parser.packet_class = Asterisk.Util.Packet
+        if self.capture is not None:
+            self.reader.parser.recorder = self.capture.received
+
+
+    def reconnect(self):
+        '''
+        Replace a lost connection. Every action in flight is failed with
+        ConnectionReset, then we connect and log in again, waiting between
+        attempts for <reconnect_delay> seconds, doubling up to
+        <reconnect_max_delay>, with random jitter so that many clients do not
+        return at once. Event subscriptions and the event mask are kept.
+
+        Once logged in, a 'Reconnect' event is passed to on_Event so that
+        cached state may be reloaded; errors raised by its handlers are
+        logged rather than raised. GoneAwayError is raised if
+        <reconnect_attempts> attempts fail.
+        '''
+
+        self.log.warning('Connection to %s:%d lost, reconnecting.', *self.address)
+
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+        futures = self.futures.values()
+        self.futures.clear()
+        self.response_buffer.clear()
+
+        if self.metrics is not None:
+            self.metrics.buffer_depth(0)
 
-        self.response_buffer = []
-        self._authenticate()
+        for future in futures:
+            future.set_exception(ConnectionReset('connection lost before response.'))
+
+        attempt = self._establish()
+
+        self.log.warning('Reconnected to %s:%d after %d attempts.',
+            self.address[0], self.address[1], attempt)
+
+        # The connection is usable again even if a handler fails to reload
+        # its state, so such errors must not reach our caller.
+        try:
+            self.on_Event(Asterisk.Util.AttributeDict({
+                'Event': 'Reconnect', 'Attempts': str(attempt)
+            }))
+        except Exception, e:
+            self.log.exception('Error while handling Reconnect event.')
+
+
+    def _establish(self):
+        '''
+        Connect and log in, retrying failed attempts with backoff as
+        described for reconnect(), and return the number of attempts made.
+        AuthenticationFailure is raised at once, as retrying cannot help.
+        '''
+
+        delay = self.reconnect_delay
+        attempt = 0
+        self.reconnecting = True
+
+        try:
+            while True:
+                attempt += 1
+                try:
+                    self._connect()
+                    self._new_action_ids()
+                    self._authenticate()
+                    return attempt
+                except AuthenticationFailure:
+                    self.sock.close()
+                    raise
+                except Exception, e:
+                    if getattr(self, 'sock', None) is not None:
+                        self.sock.close()
+
+                    if self.reconnect_attempts is not None and \
+                            attempt >= self.reconnect_attempts:
+                        raise GoneAwayError('could not connect after %d attempts: %s'\
+                            % (attempt, e))
+
+                    wait = delay / 2 + random.uniform(0, delay / 2)
+                    self.log.debug('Connect attempt %d failed (%s), retrying in %.1fs.',
+                        attempt, e, wait)
+                    time.sleep(wait)
+                    delay = min(delay * 2, self.reconnect_max_delay)
+        finally:
+            self.reconnecting = False
 
 
     def get_channel(self, channel_id):
-        'Return a channel object for the given <channel_id>.'
+        '''
+        Return a channel object for the given <channel_id>. The same object is
+        returned for as long as it is referenced elsewhere.
+        '''
 
-        if channel_id[:3].lower() == 'zap':
-            return ZapChannel(self, channel_id)
-        return BaseChannel(self, channel_id)
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            if channel_id[:3].lower() == 'zap':
+                channel = ZapChannel(self, channel_id)
+            else:
+                channel = BaseChannel(self, channel_id)
+            self.channels[channel_id] = channel
+        return channel
 
 
     def _authenticate(self):
         'Read the server banner and attempt to authenticate.'
 
-        banner = self.file.readline()
+        banner = self.reader.read_banner()
         if not banner.startswith(self._AST_BANNER_PREFIX):
             raise Exception('banner incorrect; got %r, expected one of %r' %\
                             (banner, self._AST_BANNER_PREFIX))
 
+        self.log.debug('Authenticating as %r/%r.', self.username, self.secret)
+        self._write_action('Login', self._login_action())
+
+        if self._read_packet().Response == 'Error':
+            raise AuthenticationFailure('authentication failed.')
+
+        self.log.debug('Authenticated as %r.', self.username)
+
+
+    def _login_action(self):
+        'Return the header mapping for our Login action.'
+
         action = {
             'Username': self.username,
             'Secret': self.secret
@@ -235,14 +637,15 @@ class BaseManager(Asterisk.Logging.InstanceLogger):
 
         if not self.listen_events:
             action['Events'] = 'off'
+        elif self.event_mask is not None:
+            action['Events'] = ','.join(self.event_mask) or 'off'
 
-        self.log.debug('Authenticating as %r/%r.', self.username, self.secret)
-        self._write_action('Login', action)
+        return action
 
-        if self._read_packet().Response == 'Error':
-            raise AuthenticationFailure('authentication failed.')
 
-        self.log.debug('Authenticated as %r.', self.username)
+    def _wants_event(self, name):
+        'Return truth if a handler is subscribed to events named <name>.'
+        return self.events.wants(name)
 
 
     def __repr__(self):
@@ -253,6 +656,37 @@ class BaseManager(Asterisk.Logging.InstanceLogger):
              self.username) + self.address)
 
 
+    def _new_action_ids(self):
+        '''
+        Start a new ActionID sequence, with a prefix unique to this process
+        and connection.
+        '''
+
+        self.action_prefix = '%s-%d-%d-' %\
+            (_HOSTNAME, os.getpid(), _connection_numbers.next())
+        self.action_seq = itertools.count(1)
+
+
+    def _format_action(self, action, data = None):
+        '''
+        Return an (id, text) tuple for an <action> request carrying header keys
+        and values from the mapping <data>. Values from <data> are omitted if
+        they are None.
+        '''
+
+        # count.next() is atomic, so threads sharing a connection never see
+        # the same ActionID.
+        id = self.action_prefix + str(self.action_seq.next())
+        text = Asterisk.Protocol.format_action(action, id, data)
+        if self.log_packet:
+            self.log.packet('write_action: %r', text)
+
+        if self.metrics is not None:
+            self.metrics.action_sent(action, id)
+
+        return id, text
+
+
     def _write_action(self, action, data = None):
         '''
         Write an <action> request to the Manager API, sending header keys and
@@ -260,71 +694,52 @@ class BaseManager(Asterisk.Logging.InstanceLogger):
         on success. Values from <data> are omitted if they are None.
         '''
 
-        id = str(time.time()) # Assumes microsecond precision for reliability.
-        lines = [ 'Action: ' + action, 'ActionID: ' + id ]
+        id, text = self._format_action(action, data)
+        if self.log_io:
+            self.log.io('_write_action: send %r', text)
+        self._send(text)
+        return id
 
-        if data is not None:
-            for item in data.iteritems():
-                if item[1] is not None:
-                    if not isinstance(item[1], list):
-                        lines.append('%s: %s' % item)
-                    elif isinstance(item[1], list):
-                        for param in item[1]:
-                            lines.append('%s: %s' % (item[0], param))
 
-        self.log.packet('write_action: %r', lines)
+    def _send(self, text):
+        'Send the formatted request <text> to the Manager API.'
 
-        for line in lines:
-            self.file.write(line + '\r\n')
-            self.log.io('_write_action: send %r', line + '\r\n')
+        if self.capture is not None:
+            self.capture.sent(text)
 
-        self.file.write('\r\n')
-        self.log.io('_write_action: send: %r', '\r\n')
-        return id
+        try:
+            self.sock.sendall(text)
+        except socket.timeout:
+            raise
+        except socket.error, e:
+            if not self.auto_reconnect or self.reconnecting:
+                raise
+            self.reconnect()
+            raise ConnectionReset('connection lost and re-established: %s' % (e,))
 
 
-    def _read_response_follows(self):
+    def record(self, writer):
         '''
-        Continue reading the remainder of this packet, in the format sent by
-        the "command" action.
+        Append every packet sent or received from now on to the
+        Asterisk.Capture.CaptureWriter <writer>, or stop recording if None.
         '''
 
-        self.log.debug('In _read_response_follows().')
+        self.capture = writer
+        self.reader.parser.recorder = writer and writer.received
 
-        lines = []
-        packet = Asterisk.Util.AttributeDict({
-            'Response': 'Follows', 'Lines': lines
-        })
-        line_nr = 0
-        empty_line_ts = None
-        while True:
-            line = self.file.readline().rstrip()
-            self.log.io('_read_response_follows: recv %r', line)
-            line_nr += 1
-            # In some case, ActionID is the line 2 the first starting with
-            # 'Privilege:'
-            if line_nr in [1, 2] and line.startswith('ActionID: '):
-                # Asterisk is a pile of shite!!!!!!!!!
-                packet.ActionID = line[10:]
-
-            elif line == '--END COMMAND--':
-                self.file.readline()
-                self.log.debug('Completed _read_response_follows().')
-                return packet
 
-            elif not line:
-                if self.timeout:
-                    now = datetime.datetime.now()
-                    if empty_line_ts is None:
-                        empty_line_ts = now
-                    else:
-                        if (now - empty_line_ts).seconds > self.timeout:
-                            self.log.debug("Bogus asterisk 'Command' answer.'")
-                            raise CommunicationError(packet, 'expected --END COMMAND--')
-                self.log.debug('Empty line encountered.')
+    def instrument(self, metrics):
+        '''
+        Take measurements of this session into the Asterisk.Metrics.Metrics
+        instance <metrics>, which may be shared by many sessions, or stop
+        measuring if None.
+        '''
 
-            else:
-                lines.append(line)
+        self.metrics = metrics
+        self.reader.metrics = metrics
+        self.events.metrics = metrics
+        if self.executor is not None:
+            self.executor.metrics = metrics
 
 
     def _read_packet(self, discard_events = False):
@@ -336,57 +751,69 @@ class BaseManager(Asterisk.Logging.InstanceLogger):
         Response packet, this is used while closing down the channel.
         '''
 
-        packet = Asterisk.Util.AttributeDict()
-        self.log.debug('In _read_packet().')
+        if self.log_debug:
+            self.log.debug('In _read_packet().')
 
         while True:
-            line = self.file.readline().rstrip()
-            self.log.io('_read_packet: recv %r', line)
-
-            if not line:
-                if not packet:
-                    raise GoneAwayError('Asterisk Manager connection has gone away.')
-
+            try:
+                packet = self.reader.read_packet()
+            except socket.timeout:
+                raise
+            except (GoneAwayError, socket.error), e:
+                if not self.auto_reconnect or self.reconnecting:
+                    raise
+                self.reconnect()
+                raise ConnectionReset('connection lost and re-established: %s' % (e,))
+
+            if self.log_packet:
                 self.log.packet('_read_packet: %r', packet)
 
-                if discard_events and 'Event' in packet:
+            if discard_events and 'Event' in packet:
+                if self.log_debug:
                     self.log.debug('_read_packet() discarding: %r.', packet)
-                    packet.clear()
-                    continue
+                continue
 
+            if self.log_debug:
                 self.log.debug('_read_packet() completed.')
-                return packet
-
-            val = None
-            if line.count(':') == 1 and line[-1] == ':': # Empty field:
-                key, val = line[:-1], ''
-            elif line.count(',') == 1 and line[0] == ' ': # ChannelVariable
-                key, val = line[1:].split(',', 1)
-            else:
-                # Some asterisk features like 'XMPP' presence
-                # send bogus packets with empty lines in the datas
-                # We should properly fail on those packets.
-                try:
-                    key, val = line.split(': ', 1)
-                except:
-                    raise InternalError('Malformed packet detected: %r' % (packet,))
-            if key == 'Response' and val == 'Follows':
-                return self._read_response_follows()
-
-            packet[key] = val
+            return packet
 
 
     def _dispatch_packet(self, packet):
         'Feed a single packet to an event handler.'
 
-        if 'Response' in packet:
-            self.log.debug('_dispatch_packet() placed response in buffer.')
-            self.response_buffer.append(packet)
-
-        elif 'Event' in packet:
+        # Some events, such as OriginateResponse, also carry a Response header,
+        # so test for events first.
+        if 'Event' in packet:
             self._translate_event(packet)
-            self.log.debug('_dispatch_packet() passing event to on_Event.')
-            self.on_Event(packet)
+
+            # Events carrying an ActionID answer an action whose caller may be
+            # waiting on their handlers, so they are never deferred.
+            if self.executor is None or 'ActionID' in packet:
+                if self.log_debug:
+                    self.log.debug('_dispatch_packet() passing event to on_Event.')
+                self.on_Event(packet)
+            else:
+                self.executor.submit(self.on_Event, packet)
+
+        elif 'Response' in packet:
+            id = packet.get('ActionID')
+            future = self.futures.pop(id, None)
+
+            if self.metrics is not None:
+                self.metrics.action_completed(id)
+
+            if future is not None:
+                if self.log_debug:
+                    self.log.debug('_dispatch_packet() resolved %r.', future)
+                packet.pop('ActionID')
+                future.set_response(packet)
+            else:
+                if self.log_debug:
+                    self.log.debug('_dispatch_packet() placed response in buffer.')
+                self.response_buffer[id] = packet
+
+                if self.metrics is not None:
+                    self.metrics.buffer_depth(len(self.response_buffer))
 
         else:
             raise InternalError('Unknown packet type detected: %r' % (packet,))
@@ -425,36 +852,39 @@ class BaseManager(Asterisk.Logging.InstanceLogger):
         'Log off and close the connection to the PBX.'
 
         self.log.debug('Closing down.')
+        self.auto_reconnect = False
 
         self._write_action('Logoff')
         packet = self._read_packet(discard_events = True)
         if packet.Response != 'Goodbye':
             raise CommunicationError(packet, 'expected goodbye')
-        self.file.close()
+        self.sock.close()
 
 
     def read(self):
         'Called by the parent code when activity is detected on our fd.'
 
-        self.log.io('read(): Activity detected on our fd.')
+        if self.log_io:
+            self.log.io('read(): Activity detected on our fd.')
         packet = self._read_packet()
         self._dispatch_packet(packet)
 
+        # The fd will not become readable again for packets that arrived in
+        # the same block, so handle them now.
+        while self.reader.pending():
+            self._dispatch_packet(self._read_packet())
 
-    def read_response(self, id):
-        'Return the response packet found for the given action <id>.'
 
-        buffer = self.response_buffer
+    def read_response(self, id, more = False):
+        '''
+        Return the response packet found for the given action <id>. If <more>
+        is True, the caller goes on to read further packets for <id> with
+        _read_packet(), and calls _action_done() once it has finished.
+        '''
 
-        while True:
-            if buffer:
-                for idx, packet in enumerate(buffer):
-                    # It is an error if no ActionID is sent. This is intentional.
-                    if packet.ActionID == id:
-                        buffer.pop(idx)
-                        packet.pop('ActionID')
-                        return packet
+        buffer = self.response_buffer
 
+        while id not in buffer:
             packet = self._read_packet()
 
 
@@ -465,17 +895,142 @@ class BaseManager(Asterisk.Logging.InstanceLogger):
                 raise CommunicationError(packet, 'no ActionID')
 
             elif packet.ActionID == id:
+                if self.metrics is not None:
+                    self.metrics.action_completed(id)
+
                 packet.pop('ActionID')
                 return packet
 
             else:
-                buffer.append(packet)
+                self._dispatch_packet(packet)
+
+        packet = buffer.pop(id)
+        packet.pop('ActionID')
+
+        if self.metrics is not None:
+            self.metrics.buffer_depth(len(buffer))
+
+        return packet
+
+
+    def _action_done(self, id):
+        'Note that no more packets are expected for action <id>.'
+        pass
+
+
+    def send_action(self, action, data = None):
+        '''
+        Write an <action> request without waiting for its response, returning
+        an ActionFuture that is resolved when the response arrives.
+        '''
+
+        id, text = self._format_action(action, data)
+
+        # Register before writing, so a response read by another thread can
+        # never arrive ahead of its future.
+        future = self.futures[id] = ActionFuture(self, action, id)
+
+        if self.log_io:
+            self.log.io('send_action: send %r', text)
+        self._send(text)
+        return future
+
+
+    def send_actions(self, actions, window = 256):
+        '''
+        Pipeline the (action, data) tuples from the iterable <actions>, writing
+        up to <window> requests at a time before waiting for their responses.
+        Return a list of ActionFuture objects in request order.
+        '''
+
+        futures = []
+        actions = iter(actions)
+
+        while True:
+            batch = []
+            for action, data in actions:
+                id, text = self._format_action(action, data)
+                future = self.futures[id] = ActionFuture(self, action, id)
+                futures.append(future)
+                batch.append(text)
+
+                if len(batch) == window:
+                    break
+
+            if batch:
+                text = ''.join(batch)
+                if self.log_io:
+                    self.log.io('send_actions: send %r', text)
+                self._send(text)
+
+            if len(batch) < window:
+                return futures
+
+            # Bound the number of requests in flight so neither side's
+            # socket buffers fill up.
+            self.wait(futures[-1])
+
+
+    def list_action(self, action, data = None):
+        '''
+        Send the list <action>, such as Status, and yield each event it
+        returns as soon as it is read, stopping at the event that completes
+        the list. The events are told apart from other traffic by their
+        ActionID; other packets read meanwhile are dispatched as usual. Each
+        list event, including the completing one, is also passed to on_Event,
+        so handlers such as on_Status still see it.
+        '''
+
+        id = self._write_action(action, data)
+
+        try:
+            self._translate_response(self.read_response(id, more = True))
+
+            while True:
+                packet = self._read_packet()
+
+                if 'Event' not in packet or packet.get('ActionID') != id:
+                    self._dispatch_packet(packet)
+                    continue
+
+                self._translate_event(packet)
+                self.on_Event(packet)
+
+                if packet.get('EventList') == 'Complete' or \
+                        packet['Event'].endswith('Complete'):
+                    return
+
+                yield packet
+        finally:
+            self._action_done(id)
+
+
+    def list_dict(self, action, key, data = None):
+        '''
+        Send the list <action> and return a dict of its events, without their
+        Event and ActionID headers, keyed by and without header <key>.
+        '''
+
+        entries = {}
+
+        for event in self.list_action(action, data):
+            entry = self.strip_evinfo(event)
+            entries[entry.pop(key)] = entry
+
+        return entries
+
+
+    def wait(self, future):
+        'Read and dispatch packets until <future> is resolved.'
+
+        while not future.done():
+            self._dispatch_packet(self._read_packet())
 
 
     def on_Event(self, event):
         'Triggered when an event is received from the Manager.'
 
-        self.events.fire(event.Event, self, event)
+        self.events.fire_event(self, event)
 
 
     def responses_waiting(self):
@@ -485,10 +1040,16 @@ class BaseManager(Asterisk.Logging.InstanceLogger):
 
 
     def serve_forever(self):
-        'Handle one event at a time until doomsday.'
+        '''
+        Handle one event at a time until doomsday, or until the connection is
+        lost and cannot be re-established.
+        '''
 
         while True:
-            packet = self._read_packet()
+            try:
+                packet = self._read_packet()
+            except ConnectionReset:
+                continue
             self._dispatch_packet(packet)
 
 
@@ -544,11 +1105,13 @@ class CoreActions(object):
 
         id = self._write_action('DBGet', {'Family': family, 'Key': key})
         try:
-            response = self._translate_response(self.read_response(id))
+            response = self._translate_response(self.read_response(id, more = True))
+            if response.get('Response') == 'Success':
+                packet = self._read_packet()
         except Asterisk.Manager.ActionFailed as e:
             return str(e)
-        if response.get('Response') == 'Success':
-            packet = self._read_packet()
+        finally:
+            self._action_done(id)
         return packet.get('Value')
 
 
@@ -556,16 +1119,17 @@ class CoreActions(object):
         'Filter received events to only those in the list <categories>.'
 
         id = self._write_action('Events', { 'EventMask': ','.join(categories) })
-        return self._translate_response(self.read_response(id))
+        response = self._translate_response(self.read_response(id))
+        self.event_mask = list(categories)
+        return response
 
 
     def ExtensionStates(self):
         'Return nested dictionary of contexts, extensions and their state'
 
-        hint_re = re.compile(r'\s+(\d+)@(\S+).+State:(\S+)')
         state_dict = dict()
         for line in self.Command('core show hints'):
-            match = hint_re.search(line)
+            match = _HINT_RE.search(line)
             if match:
                 extension, context, state = match.groups()
                 if context in state_dict:
@@ -583,18 +1147,25 @@ class CoreActions(object):
 
         self.log.debug('Getvar(%r, %r, default=%r)', channel, variable, default)
 
-        id = self._write_action('Getvar', {
-            'Channel': channel,
-            'Variable': variable
-        })
+        cache = self.variable_cache
+        value = Asterisk.Util.Unspecified
 
-        response = self._translate_response(self.read_response(id))
-        if response.has_key(variable):
-            value = response[variable]
-        else:
-            value = response['Value']
+        if cache is not None:
+            value = cache.lookup(channel, variable)
 
-        if value == '(null)':
+        if value is Asterisk.Util.Unspecified:
+            id = self._write_action('Getvar', {
+                'Channel': channel,
+                'Variable': variable
+            })
+
+            response = self._translate_response(self.read_response(id))
+            value = self._getvar_value(response, variable)
+
+            if cache is not None:
+                cache.store(channel, variable, value)
+
+        if value is None:
             if default is Asterisk.Util.Unspecified:
                 raise KeyError(variable)
             else:
@@ -605,6 +1176,61 @@ class CoreActions(object):
         return value
 
 
+    @staticmethod
+    def _getvar_value(response, variable):
+        'Return the value of <variable> in Getvar <response>, or None if unset.'
+
+        if response.has_key(variable):
+            value = response[variable]
+        else:
+            value = response['Value']
+
+        if value == '(null)':
+            return None
+        return value
+
+
+    def Getvars(self, channel, variables, default = None):
+        '''
+        Return a dict of the values of <channel>'s <variables>, mapping those
+        that are not set to <default>. The Getvar requests are pipelined, so
+        any number of variables cost one round trip; variables held in
+        <variable_cache> cost none.
+        '''
+
+        cache = self.variable_cache
+        values = {}
+        missing = []
+
+        for variable in variables:
+            value = Asterisk.Util.Unspecified
+            if cache is not None:
+                value = cache.lookup(channel, variable)
+
+            if value is Asterisk.Util.Unspecified:
+                missing.append(variable)
+            else:
+                values[variable] = value
+
+        futures = self.send_actions([ ('Getvar', {
+            'Channel': channel,
+            'Variable': variable
+        }) for variable in missing ])
+
+        for variable, future in zip(missing, futures):
+            response = future.result()
+            value = values[variable] = self._getvar_value(response, variable)
+
+            if cache is not None:
+                cache.store(channel, variable, value)
+
+        for variable, value in values.iteritems():
+            if value is None:
+                values[variable] = default
+
+        return values
+
+
     def Hangup(self, channel):
         'Hangup <channel>.'
 
@@ -653,9 +1279,8 @@ class CoreActions(object):
         if resp[1] == 'No active MeetMe conferences.':
             return meetme_list
         else:
-            meetme_re = re.compile(r'^(?P<confnum>\d+)\s+(?P<parties>\d+)\s+(?P<marked>\S+)\s+(?P<activity>\S+)\s+(?P<creation>\S+)')
             for line in resp:
-                match = meetme_re.search(line)
+                match = _MEETME_RE.search(line)
                 if match:
                     meetme_list.append(match.groupdict())
         return meetme_list
@@ -669,9 +1294,8 @@ class CoreActions(object):
         if (resp[1] == 'No active conferences.') or ('No such conference' in resp[1]):
             return caller_list
         else:
-            meetme_re = re.compile(r'^User #: (?P<usernum>\d+)\s+(?P<callerid>.+)\s+Channel: (?P<channel>\S+)\s+\((?P<monitor>.+)\)\s+(?P<duration>\S+)')
             for line in resp:
-                match = meetme_re.search(line)
+                match = _MEETME_USER_RE.search(line)
                 if match:
                     caller_list.append(match.groupdict())
         return caller_list
@@ -714,6 +1338,18 @@ class CoreActions(object):
             <async>         Return successfully immediately.
         '''
 
+        data = self._originate_data(channel, context, extension, priority,
+            application, data, timeout, caller_id, variable, account, async)
+
+        id = self._write_action('Originate', data)
+        return self._translate_response(self.read_response(id))
+
+
+    def _originate_data(self, channel, context = None, extension = None,
+    priority = None, application = None, data = None, timeout = None,
+    caller_id = None, variable = None, account = None, async = None):
+        'Check the arguments of Originate() and return its request fields.'
+
         # Since channel is a required parameter, no need including it here.
         # As a matter of fact, including it here, generates an AttributeError
         # because 'None' does not have an 'id' attribute which is required in
@@ -732,7 +1368,7 @@ class CoreActions(object):
             raise ActionFailed('Originate: you must specify a channel.')
 
 
-        data = {
+        return {
             'Channel': channel,             'Context': context,
             'Exten': extension,             'Priority': priority,
             'Application': application,     'Data': data,
@@ -741,9 +1377,6 @@ class CoreActions(object):
             'Async': int(bool(async))
         }
 
-        id = self._write_action('Originate', data)
-        return self._translate_response(self.read_response(id))
-
 
     def Originate2(self, channel, parameters):
         '''
@@ -758,31 +1391,7 @@ class CoreActions(object):
     def ParkedCalls(self):
         'Return a nested dict describing currently parked calls.'
 
-        id = self._write_action('ParkedCalls')
-        self._translate_response(self.read_response(id))
-        parked = {}
-
-        def ParkedCall(self, event):
-            event = self.strip_evinfo(event)
-            parked[event.pop('Exten')] = event
-
-        def ParkedCallsComplete(self, event):
-            stop_flag[0] = True
-
-        events = Asterisk.Util.EventCollection([ ParkedCall, ParkedCallsComplete ])
-        self.events += events
-
-        try:
-            stop_flag = [ False ]
-
-            while stop_flag[0] == False:
-                packet = self._read_packet()
-                self._dispatch_packet(packet)
-
-        finally:
-            self.events -= events
-
-        return parked
+        return self.list_dict('ParkedCalls', 'Exten')
 
 
 
@@ -832,40 +1441,22 @@ class CoreActions(object):
     def QueueStatus(self):
         'Return a complex nested dict describing queue statii.'
 
-        id = self._write_action('QueueStatus')
-        self._translate_response(self.read_response(id))
         queues = {}
 
-        def QueueParams(self, event):
-            queue = self.strip_evinfo(event)
-            queue['members'] = {}
-            queue['entries'] = {}
-            queues[queue.pop('Queue')] = queue
-
-        def QueueMember(self, event):
-            member = self.strip_evinfo(event)
-            queues[member.pop('Queue')]['members'][member.pop('Location')] = member
-
-        def QueueEntry(self, event):
+        for event in self.list_action('QueueStatus'):
+            name = event['Event']
             entry = self.strip_evinfo(event)
-            queues[entry.pop('Queue')]['entries'][event.pop('Channel')] = entry
 
-        def QueueStatusComplete(self, event):
-            stop_flag[0] = True
+            if name == 'QueueParams':
+                entry['members'] = {}
+                entry['entries'] = {}
+                queues[entry.pop('Queue')] = entry
 
-        events = Asterisk.Util.EventCollection([
-            QueueParams, QueueMember, QueueEntry, QueueStatusComplete])
-        self.events += events
+            elif name == 'QueueMember':
+                queues[entry.pop('Queue')]['members'][entry.pop('Location')] = entry
 
-        try:
-            stop_flag = [False]
-
-            while stop_flag[0] == False:
-                packet = self._read_packet()
-                self._dispatch_packet(packet)
-
-        finally:
-            self.events -= events
+            elif name == 'QueueEntry':
+                queues[entry.pop('Queue')]['entries'][event['Channel']] = entry
 
         return queues
 
@@ -910,7 +1501,38 @@ class CoreActions(object):
             'Value': value
         })
 
-        return self._translate_response(self.read_response(id))
+        response = self._translate_response(self.read_response(id))
+
+        if self.variable_cache is not None:
+            self.variable_cache.assign(channel, variable, value)
+
+        return response
+
+
+    def Setvars(self, channel, mapping):
+        '''
+        Set the variables of <channel> to the values in <mapping>. The Setvar
+        requests are pipelined, so any number of variables cost one round
+        trip. Return a list of the responses, in request order.
+        '''
+
+        items = list(mapping.iteritems())
+
+        futures = self.send_actions([ ('Setvar', {
+            'Channel': channel,
+            'Variable': variable,
+            'Value': value
+        }) for (variable, value) in items ])
+
+        cache = self.variable_cache
+        responses = []
+
+        for (variable, value), future in zip(items, futures):
+            responses.append(future.result())
+            if cache is not None:
+                cache.assign(channel, variable, value)
+
+        return responses
 
 
     def SipShowPeer(self, peer):
@@ -924,61 +1546,13 @@ class CoreActions(object):
     def SipShowRegistry(self):
         'Return a nested dict of SIP registry.'
 
-        id = self._write_action('SIPshowregistry')
-        self._translate_response(self.read_response(id))
-        registry = {}
-
-        def RegistryEntry(self, event):
-            event = self.strip_evinfo(event)
-            name = event.pop('Host')
-            registry[name] = event
-
-        def RegistrationsComplete(self, event):
-            stop_flag[0] = True
-
-        events = Asterisk.Util.EventCollection([ RegistryEntry, RegistrationsComplete ])
-        self.events += events
-
-        try:
-            stop_flag = [ False ]
-
-            while stop_flag[0] == False:
-                packet = self._read_packet()
-                self._dispatch_packet(packet)
-
-        finally:
-            self.events -= events
-        return registry
+        return self.list_dict('SIPshowregistry', 'Host')
 
 
     def Status(self):
         'Return a nested dict of channel statii.'
 
-        id = self._write_action('Status')
-        self._translate_response(self.read_response(id))
-        channels = {}
-
-        def Status(self, event):
-            event = self.strip_evinfo(event)
-            name = event.pop('Channel')
-            channels[name] = event
-
-        def StatusComplete(self, event):
-            stop_flag[0] = True
-
-        events = Asterisk.Util.EventCollection([ Status, StatusComplete ])
-        self.events += events
-
-        try:
-            stop_flag = [ False ]
-
-            while stop_flag[0] == False:
-                packet = self._read_packet()
-                self._dispatch_packet(packet)
-
-        finally:
-            self.events -= events
-        return channels
+        return self.list_dict('Status', 'Channel')
 
 
     def StopMonitor(self, channel):
@@ -1028,31 +1602,11 @@ class ZapataActions(object):
     def ZapShowChannels(self):
         'Return a nested dict of Zapata driver channel statii.'
 
-        id = self._write_action('ZapShowChannels')
-        self._translate_response(self.read_response(id))
         channels = {}
 
-        def ZapShowChannels(self, event):
+        for event in self.list_action('ZapShowChannels'):
             event = self.strip_evinfo(event)
-            number = int(event.pop('Channel'))
-            channels[number] = event
-
-        def ZapShowChannelsComplete(self, event):
-            stop_flag[0] = True
-
-        events = Asterisk.Util.EventCollection([
-            ZapShowChannels, ZapShowChannelsComplete ])
-        self.events += events
-
-        try:
-            stop_flag = [ False ]
-
-            while stop_flag[0] == False:
-                packet = self._read_packet()
-                self._dispatch_packet(packet)
-
-        finally:
-            self.events -= events
+            channels[int(str(event.pop('Channel')))] = event
 
         return channels
 
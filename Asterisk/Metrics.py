@@ -0,0 +1,280 @@
+'''
+Asterisk/Metrics.py: counters and latency histograms for Manager sessions.
+
+Managers, packet readers and event collections take no measurements at all
+unless a Metrics instance is attached with BaseManager.instrument(), so the
+default costs one attribute test per packet. A Metrics instance records:
+
+    bytes_read, packets_read, blocks_read   Counters, with per-second rates
+                                            in snapshots.
+    parse                                   Mean parse time per packet for
+                                            each block read.
+    rtt.<action>                            Round trip time of each action,
+                                            from writing the request to
+                                            reading its response.
+    handler.<event>                         Time spent in event handlers for
+                                            each event name.
+    response_buffer                         Depth of the response buffer,
+                                            and its high-water mark.
+
+Snapshots are plain dicts, passed to every exporter by export(), so they may
+be forwarded to any monitoring system.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import time, bisect, threading, collections
+
+
+
+
+# Histogram bucket upper bounds, in seconds: 10us to 30s.
+
+BUCKETS = (
+    0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005,
+    0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0
+)
+
+# Bound on the number of unanswered actions tracked, so actions whose
+# responses never arrive cannot grow memory without limit; the oldest are
+# forgotten first.
+
+_MAX_INFLIGHT = 65536
+
+
+
+
+class Histogram(object):
+    'Distribution of latency samples over fixed logarithmic buckets.'
+
+    def __init__(self, bounds = BUCKETS):
+        self.bounds = bounds
+        self.counts = [ 0 ] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def observe(self, value):
+        'Record the sample <value>.'
+
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+    def percentile(self, fraction):
+        '''
+        Return the upper bound of the bucket holding the sample at <fraction>
+        (eg. 0.99) of the distribution, or the largest sample if that falls
+        past the last bucket.
+        '''
+
+        if not self.count:
+            return 0.0
+
+        wanted = fraction * self.count
+        seen = 0
+
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count:
+                if idx < len(self.bounds):
+                    return min(self.bounds[idx], self.max)
+                break
+
+        return self.max
+
+
+    def snapshot(self):
+        'Return a dict summarising the distribution.'
+
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.count and self.total / self.count or 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': zip(self.bounds + (None,), self.counts),
+        }
+
+
+
+
+class Metrics(object):
+    '''
+    Collector for the counters, gauges and histograms of one or more Manager
+    sessions. Attach it with BaseManager.instrument().
+
+    Measurements are taken under a lock, so one instance may be shared by
+    sessions and executor workers running on different threads.
+    '''
+
+    def __init__(self, exporters = None):
+        '''
+        Initialise an empty collector. <exporters> is a list of callables
+        passed each snapshot by export().
+        '''
+
+        self.exporters = list(exporters or ())
+        self.lock = threading.Lock()
+        self.inflight = collections.OrderedDict()
+        self.reset()
+
+
+    def reset(self):
+        'Discard every measurement taken so far.'
+
+        self.lock.acquire()
+        try:
+            self.started = time.time()
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+        finally:
+            self.lock.release()
+
+
+    # Generic instruments.
+
+    def count(self, name, value = 1):
+        'Add <value> to counter <name>.'
+
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self.lock.release()
+
+
+    def gauge(self, name, value):
+        'Set gauge <name> to <value>, tracking its high-water mark.'
+
+        self.lock.acquire()
+        try:
+            current, peak = self.gauges.get(name, (0, 0))
+            self.gauges[name] = (value, max(peak, value))
+        finally:
+            self.lock.release()
+
+
+    def observe(self, name, value):
+        'Record the sample <value> in histogram <name>.'
+
+        self.lock.acquire()
+        try:
+            self._observe(name, value)
+        finally:
+            self.lock.release()
+
+
+    def _observe(self, name, value):
+        'Record the sample <value> in histogram <name>; the lock must be held.'
+
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+
+    # Hooks called by managers, readers and event collections.
+
+    def action_sent(self, action, id):
+        'Note that <action> was sent with action identifier <id>.'
+
+        self.lock.acquire()
+        try:
+            if len(self.inflight) >= _MAX_INFLIGHT:
+                self.inflight.popitem(last = False)
+            self.inflight[id] = (action, time.time())
+        finally:
+            self.lock.release()
+
+
+    def action_completed(self, id):
+        'Note that the response to action identifier <id> was read.'
+
+        self.lock.acquire()
+        try:
+            sent = self.inflight.pop(id, None)
+            if sent is not None:
+                action, started = sent
+                self._observe('rtt.' + action, time.time() - started)
+        finally:
+            self.lock.release()
+
+
+    def packets_read(self, size, count, seconds):
+        '''
+        Note that a block of <size> bytes was read, completing <count> packets
+        which took <seconds> to parse.
+        '''
+
+        self.lock.acquire()
+        try:
+            counters = self.counters
+            counters['blocks_read'] = counters.get('blocks_read', 0) + 1
+            counters['bytes_read'] = counters.get('bytes_read', 0) + size
+
+            if count:
+                counters['packets_read'] = counters.get('packets_read', 0) + count
+                self._observe('parse', seconds / count)
+        finally:
+            self.lock.release()
+
+
+    def event_handled(self, name, seconds):
+        'Note that handlers for event <name> took <seconds> to run.'
+        self.observe('handler.' + name, seconds)
+
+
+    def buffer_depth(self, depth):
+        'Note that the response buffer holds <depth> packets.'
+        self.gauge('response_buffer', depth)
+
+
+    # Reporting.
+
+    def snapshot(self):
+        'Return a dict of every measurement taken since the last reset().'
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            elapsed = now - self.started
+
+            return {
+                'time': now,
+                'elapsed': elapsed,
+                'counters': dict(self.counters),
+                'rates': dict([ (name, elapsed and value / elapsed or 0.0)
+                    for (name, value) in self.counters.iteritems() ]),
+                'gauges': dict([ (name, { 'value': value, 'max': peak })
+                    for (name, (value, peak)) in self.gauges.iteritems() ]),
+                'histograms': dict([ (name, histogram.snapshot())
+                    for (name, histogram) in self.histograms.iteritems() ]),
+            }
+        finally:
+            self.lock.release()
+
+
+    def export(self, reset = False):
+        '''
+        Pass a snapshot to every exporter and return it. If <reset> is True,
+        start a new measurement period afterwards.
+        '''
+
+        snapshot = self.snapshot()
+
+        for exporter in self.exporters:
+            exporter(snapshot)
+
+        if reset:
+            self.reset()
+
+        return snapshot
@@ -0,0 +1,255 @@
+'''
+Asterisk/Pool.py: a pool of authenticated Manager sessions.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import socket, threading, time, contextlib
+import Asterisk, Asterisk.Logging
+from Asterisk import Config, Manager
+
+
+
+
+class PoolExhausted(Asterisk.BaseException):
+    '''
+    This exception is raised when no session becomes available for a
+    connection profile before the acquire timeout expires.
+    '''
+
+    _prefix = 'connection pool exhausted'
+
+
+
+
+class _Profile(object):
+    'Sessions belonging to one connection profile.'
+
+    def __init__(self, args):
+        self.args = args
+        self.idle = []     # (manager, last_used) tuples, most recent last.
+        self.count = 0     # Sessions created and not yet discarded.
+
+
+
+
+class ManagerPool(Asterisk.Logging.InstanceLogger):
+    '''
+    Thread-safe pool of authenticated Manager sessions, keyed by the name of
+    the Config connection profile they were created from. Sessions are
+    checked with a Ping before reuse if they have been idle for a while, and
+    closed once they have been idle for too long.
+
+        pool = ManagerPool()
+
+        with pool.session() as manager:
+            manager.Originate(...)
+    '''
+
+    _GONE_AWAY = (Manager.GoneAwayError, socket.error)
+
+    def __init__(self, config = None, manager_class = Manager.Manager,
+            max_size = 8, max_idle = 300.0, check_after = 30.0,
+            listen_events = False, timeout = None):
+        '''
+        Create sessions of <manager_class> using profiles from the Config
+        instance <config>, or a new Config if None. At most <max_size>
+        sessions are kept per profile. Sessions idle for <check_after> seconds
+        are pinged before reuse, and closed after <max_idle> seconds.
+        <listen_events> and <timeout> are passed to <manager_class>.
+        '''
+
+        if config is None:
+            config = Config.Config()
+
+        self.config = config
+        self.manager_class = manager_class
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self.listen_events = listen_events
+        self.timeout = timeout
+
+        self.profiles = {}
+        self.owners = {}
+        self.lock = threading.Condition()
+        self.log = self.getLogger()
+
+
+    def _get_profile(self, connection):
+        profile = self.profiles.get(connection)
+        if profile is None:
+            args = self.config.get_connection(connection)
+            profile = self.profiles[connection] = _Profile(args)
+        return profile
+
+
+    def _connect(self, profile):
+        address, username, secret = profile.args
+        self.log.debug('Connecting to %r as %r.', address, username)
+        return self.manager_class(address, username, secret,
+            listen_events = self.listen_events, timeout = self.timeout)
+
+
+    def _close(self, manager):
+        'Close <manager>, ignoring errors from a dead connection.'
+
+        try:
+            manager.close()
+        except Exception, e:
+            self.log.debug('Error closing %r: %s', manager, e)
+            try:
+                manager.sock.close()
+            except Exception:
+                pass
+
+
+    def _healthy(self, manager):
+        '''
+        Return truth if <manager> still answers a Ping. Any failure, such as
+        a timeout or a garbled response, means the session cannot be trusted.
+        '''
+
+        try:
+            manager.Ping()
+            return True
+        except Exception, e:
+            self.log.debug('Discarding dead session %r: %s', manager, e)
+            return False
+
+
+    def _expire(self, profile, now):
+        'Remove and return sessions of <profile> idle beyond max_idle.'
+
+        expired = [ m for (m, used) in profile.idle if now - used > self.max_idle ]
+        if expired:
+            profile.idle = [ x for x in profile.idle if x[0] not in expired ]
+            profile.count -= len(expired)
+        return expired
+
+
+    def acquire(self, connection = None, timeout = None):
+        '''
+        Return a session for connection profile <connection>, or the default
+        profile if None, creating one if fewer than max_size exist. Wait up to
+        <timeout> seconds (forever if None) for a session to be released if
+        the pool is full, then raise PoolExhausted.
+        '''
+
+        deadline = timeout is not None and time.time() + timeout
+
+        while True:
+            self.lock.acquire()
+            try:
+                profile = self._get_profile(connection)
+                now = time.time()
+                expired = self._expire(profile, now)
+
+                while not profile.idle and profile.count >= self.max_size:
+                    remaining = deadline and deadline - time.time()
+                    if deadline and remaining <= 0:
+                        raise PoolExhausted('no session available for %r.' % (connection,))
+                    self.lock.wait(remaining or None)
+
+                if profile.idle:
+                    manager, used = profile.idle.pop()
+                    check = time.time() - used > self.check_after
+                else:
+                    manager, check = None, False
+                    profile.count += 1
+
+            finally:
+                self.lock.release()
+
+            for stale in expired:
+                self._close(stale)
+
+            if manager is None:
+                try:
+                    manager = self._connect(profile)
+                except:
+                    self._discard(profile)
+                    raise
+
+            elif check and not self._healthy(manager):
+                self._close(manager)
+                self._discard(profile)
+                continue
+
+            self.lock.acquire()
+            try:
+                self.owners[manager] = profile
+            finally:
+                self.lock.release()
+
+            return manager
+
+
+    def _discard(self, profile):
+        self.lock.acquire()
+        try:
+            profile.count -= 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+
+    def release(self, manager, discard = False):
+        '''
+        Return <manager> to the pool. If <discard> is True, the session is
+        closed instead, for example after it raised GoneAwayError.
+        '''
+
+        self.lock.acquire()
+        try:
+            profile = self.owners.pop(manager)
+
+            if not discard:
+                profile.idle.append((manager, time.time()))
+                self.lock.notify()
+                return
+
+        finally:
+            self.lock.release()
+
+        self._close(manager)
+        self._discard(profile)
+
+
+    @contextlib.contextmanager
+    def session(self, connection = None, timeout = None):
+        '''
+        Context manager acquiring a session for <connection>, releasing it on
+        exit and discarding it if the connection went away.
+        '''
+
+        manager = self.acquire(connection, timeout)
+
+        try:
+            yield manager
+        except self._GONE_AWAY:
+            self.release(manager, discard = True)
+            raise
+        except:
+            self.release(manager)
+            raise
+        else:
+            self.release(manager)
+
+
+    def close(self):
+        'Close every idle session. Sessions in use are pooled on release.'
+
+        self.lock.acquire()
+        try:
+            idle = []
+            for profile in self.profiles.values():
+                idle.extend([ m for (m, used) in profile.idle ])
+                profile.count -= len(profile.idle)
+                profile.idle = []
+        finally:
+            self.lock.release()
+
+        for manager in idle:
+            self._close(manager)
@@ -0,0 +1,274 @@
+'''
+Asterisk/Protocol.py: Manager API framing, free of any I/O.
+
+Parser turns bytes received from the Manager API into packets, and
+format_action() turns an action request into the bytes to send. Neither
+touches a socket, so the same code serves blocking sockets, asyncore
+sessions, recorded captures, and benchmarks.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import Asterisk, Asterisk.Util
+
+
+
+
+class ParseError(Asterisk.BaseException):
+    'This exception is raised when malformed packet data is fed to a Parser.'
+    _prefix = 'malformed packet'
+
+
+
+
+FOLLOWS = 'Response: Follows'
+END_COMMAND = '--END COMMAND--'
+TERMINATOR = '\r\n\r\n'
+
+# Bytes of buffered data kept in view, so a marker split across two received
+# blocks is still seen.
+
+_TAIL = len(END_COMMAND)
+
+
+
+
+def parse_packet(text, packet_class = Asterisk.Util.AttributeDict):
+    '''
+    Return the packet represented by <text>, which should not include the
+    "\r\n\r\n" terminator, as an instance of <packet_class>.
+    '''
+
+    keys = []
+    values = []
+    lines = text.split('\n')
+
+    for idx, line in enumerate(lines):
+        line = line.rstrip()
+        if not line:
+            continue
+
+        val = None
+        if line.count(':') == 1 and line[-1] == ':': # Empty field:
+            key, val = line[:-1], ''
+        elif line.count(',') == 1 and line[0] == ' ': # ChannelVariable
+            key, val = line[1:].split(',', 1)
+        else:
+            # Some asterisk features like 'XMPP' presence
+            # send bogus packets with empty lines in the datas
+            # We should properly fail on those packets.
+            try:
+                key, val = line.split(': ', 1)
+            except:
+                raise ParseError('%r' % (zip(keys, values),))
+        if key == 'Response' and val == 'Follows':
+            return parse_follows(lines[idx + 1:])
+
+        keys.append(key)
+        values.append(val)
+
+    return packet_class.from_lists(keys, values)
+
+
+
+
+def parse_follows(lines):
+    '''
+    Return the packet for the remaining <lines> of a response in the format
+    sent by the "command" action.
+    '''
+
+    output = []
+    packet = Asterisk.Util.AttributeDict({
+        'Response': 'Follows', 'Lines': output
+    })
+
+    for line_nr, line in enumerate(lines):
+        line = line.rstrip()
+        # In some case, ActionID is the line 2 the first starting with
+        # 'Privilege:'
+        if line_nr in (0, 1) and line.startswith('ActionID: '):
+            # Asterisk is a pile of shite!!!!!!!!!
+            packet.ActionID = line[10:]
+
+        elif line == END_COMMAND:
+            break
+
+        elif line:
+            output.append(line)
+
+    return packet
+
+
+
+
+def format_action(action, id, data = None):
+    '''
+    Return the request text for <action> with action identifier <id>, sending
+    header keys and values from the mapping <data>. Values from <data> are
+    omitted if they are None, and list values are sent as repeated headers.
+    '''
+
+    lines = [ 'Action: ' + action, 'ActionID: ' + id ]
+
+    if data is not None:
+        for item in data.iteritems():
+            if item[1] is not None:
+                if not isinstance(item[1], list):
+                    lines.append('%s: %s' % item)
+                elif isinstance(item[1], list):
+                    for param in item[1]:
+                        lines.append('%s: %s' % (item[0], param))
+
+    lines.append('\r\n')
+    return '\r\n'.join(lines)
+
+
+
+
+class Parser(object):
+    '''
+    Incremental Manager API parser. Bytes are passed to feed() as they
+    arrive, in blocks of any size, and every packet they complete is
+    returned.
+    '''
+
+    def __init__(self, banner = False, wants_event = None,
+            packet_class = Asterisk.Util.AttributeDict):
+        '''
+        Initialise a parser. If <banner> is True, the first line received is
+        taken to be the server banner and stored in <banner>.
+
+        If <wants_event> is not None, it is called with the name of each event
+        received, and events for which it returns false are dropped without
+        parsing their remaining headers. Events carrying an ActionID are
+        always kept, as they answer one of our own actions.
+
+        Packets are returned as instances of <packet_class>, which must
+        provide a from_lists(keys, values) constructor. If <recorder> is set,
+        it is called with the raw text of every packet received, including
+        dropped events.
+        '''
+
+        self.banner = None
+        self.expect_banner = banner
+        self.wants_event = wants_event
+        self.packet_class = packet_class
+        self.recorder = None
+        self.skipped = 0
+
+        # Blocks received since the last complete packet, the last few bytes
+        # they hold, and the marker that must arrive before they are worth
+        # parsing again. Blocks are only joined once the marker is seen, so a
+        # long packet arriving in many blocks is not rescanned for each one.
+        self.pieces = []
+        self.tail = ''
+        self.marker = TERMINATOR
+
+        # True while a "Response: Follows" packet is only partially received.
+        self.follows = False
+
+
+    @property
+    def data(self):
+        'Received text not yet parsed into packets.'
+        return ''.join(self.pieces)
+
+
+    def feed(self, data):
+        '''
+        Add received <data> and return a list of the packets it completes.
+
+        If a packet is malformed, the rest are still parsed, and ParseError
+        is raised with the good packets in its <packets> attribute.
+        '''
+
+        if self.expect_banner:
+            data = self.data + data
+            self.pieces = []
+
+            if '\n' not in data:
+                self.pieces.append(data)
+                return []
+
+            self.banner, data = data.split('\n', 1)
+            self.banner += '\n'
+            self.expect_banner = False
+
+        elif self.pieces:
+            marker = self.marker
+            self.pieces.append(data)
+
+            if marker not in data and \
+                    marker not in self.tail + data[:len(marker) - 1]:
+                self.tail = (self.tail + data)[-_TAIL:]
+                return []
+
+            data = ''.join(self.pieces)
+            self.pieces = []
+
+        chunks = data.split(TERMINATOR)
+        rest = chunks.pop()
+        packets = []
+        append = packets.append
+        wants_event = self.wants_event
+        packet_class = self.packet_class
+        recorder = self.recorder
+        follows = False
+        error = None
+        idx = 0
+
+        while idx < len(chunks):
+            chunk = chunks[idx]
+            idx += 1
+
+            if not chunk.strip():
+                continue
+
+            if wants_event is not None and chunk.startswith('Event: '):
+                end = chunk.find('\n')
+                name = chunk[7:end].rstrip() if end != -1 else chunk[7:].rstrip()
+
+                if not wants_event(name) and 'ActionID: ' not in chunk:
+                    if recorder is not None:
+                        recorder(chunk + TERMINATOR)
+                    self.skipped += 1
+                    continue
+
+            if FOLLOWS in chunk and END_COMMAND not in chunk:
+                # Command output may itself contain blank lines; keep joining
+                # blocks until the terminator is seen.
+                while idx < len(chunks) and END_COMMAND not in chunk:
+                    chunk += TERMINATOR + chunks[idx]
+                    idx += 1
+
+                if END_COMMAND not in chunk:
+                    rest = chunk + TERMINATOR + rest
+                    follows = True
+                    break
+
+            if recorder is not None:
+                recorder(chunk + TERMINATOR)
+
+            try:
+                append(parse_packet(chunk, packet_class))
+            except ParseError, e:
+                if error is None:
+                    error = e
+
+        if rest:
+            self.pieces.append(rest)
+        self.tail = rest[-_TAIL:]
+        self.follows = follows
+
+        if follows and END_COMMAND not in rest:
+            self.marker = END_COMMAND
+        else:
+            self.marker = TERMINATOR
+
+        if error is not None:
+            error.packets = packets
+            raise error
+
+        return packets
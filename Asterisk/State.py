@@ -0,0 +1,894 @@
+'''
+Asterisk/State.py: live models of PBX state, kept current from events.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import Asterisk.Util, Asterisk.Logging
+
+
+
+
+# Event keys that describe the packet rather than the object it refers to.
+
+_EVINFO_KEYS = ('Event', 'Privilege', 'ActionID')
+
+
+
+
+class ChannelRegistry(Asterisk.Logging.InstanceLogger):
+    '''
+    In-memory table of the channels active on a PBX. The table is seeded once
+    from a Status action and then updated from channel events, so lookups and
+    listings never touch the Manager API.
+
+    The registry acts as a read-only mapping of channel name to an
+    AttributeDict of the channel's last known fields, as returned by Status().
+    BaseChannel or string channel names may be used as keys.
+    '''
+
+    def __init__(self, manager, seed = True):
+        '''
+        Track channels on BaseManager <manager>, registering our event
+        handlers with it. If <seed> is True, load the current channel list
+        with a Status action.
+        '''
+
+        self.manager = manager
+        self.channels = {}
+        self.uniqueids = {}
+        self.log = self.getLogger()
+        self._hungup = None
+        self._touched = None
+
+        self.events = Asterisk.Util.EventCollection([
+            self.Newchannel, self.Newstate, self.Newcallerid, self.Newexten,
+            self.Rename, self.Link, self.Unlink, self.Hangup, self.Reconnect ])
+
+        manager.events += self.events
+        manager.channel_registry = self
+
+        if seed:
+            self.refresh()
+
+
+    def close(self):
+        'Unregister our event handlers from the manager.'
+
+        self.manager.events -= self.events
+        if self.manager.channel_registry is self:
+            self.manager.channel_registry = None
+
+
+    def refresh(self):
+        'Reload the channel table from a Status action.'
+
+        # Channels hung up while Status() runs must not be revived by it, and
+        # channels created or changed meanwhile must keep their newer state.
+        self._hungup = set()
+        self._touched = set()
+
+        try:
+            statii = self.manager.Status()
+        finally:
+            hungup, self._hungup = self._hungup, None
+            touched, self._touched = self._touched, None
+
+        statii = dict([ (str(channel), status)
+            for (channel, status) in statii.iteritems() ])
+
+        channels = {}
+        for name, status in statii.iteritems():
+            if name not in hungup and name not in touched:
+                state = self.channels.get(name) or Asterisk.Util.AttributeDict()
+                state.update(status)
+                channels[name] = state
+
+        # Events are newer than the snapshot, so only fill in fields they
+        # did not carry.
+        for name in touched:
+            state = self.channels.get(name)
+            if state is not None:
+                for key, value in statii.get(name, {}).iteritems():
+                    state.setdefault(key, value)
+                channels[name] = state
+
+        self.channels = channels
+        self.uniqueids = dict([ (state['Uniqueid'], name)
+            for (name, state) in channels.iteritems() if 'Uniqueid' in state ])
+
+
+    def _touch(self, name):
+        'Note that channel <name> changed while a refresh is running.'
+
+        if self._touched is not None:
+            self._touched.add(name)
+
+
+    def _update(self, name, event):
+        'Merge the fields of <event> into the state of channel <name>.'
+
+        state = self.channels.get(name)
+        if state is None:
+            state = self.channels[name] = Asterisk.Util.AttributeDict()
+
+        for key, value in event.iteritems():
+            if key not in _EVINFO_KEYS and key != 'Channel':
+                state[key] = value
+
+        if 'Uniqueid' in event:
+            self.uniqueids[event['Uniqueid']] = name
+
+        self._touch(name)
+        return state
+
+
+    def _remove(self, name):
+        state = self.channels.pop(name, None)
+        if state is not None and 'Uniqueid' in state:
+            self.uniqueids.pop(state['Uniqueid'], None)
+        if self._hungup is not None:
+            self._hungup.add(name)
+        if self._touched is not None:
+            self._touched.discard(name)
+
+
+    # Event handlers.
+
+    def Newchannel(self, manager, event):
+        self._update(str(event.Channel), event)
+
+    def Newstate(self, manager, event):
+        self._update(str(event.Channel), event)
+
+    def Newcallerid(self, manager, event):
+        self._update(str(event.Channel), event)
+
+    def Newexten(self, manager, event):
+        self._update(str(event.Channel), event)
+
+    def Rename(self, manager, event):
+        old = str(event.get('Oldname') or event.get('Channel'))
+        new = event.Newname
+        state = self.channels.pop(old, None)
+
+        if state is not None:
+            self.channels[new] = state
+            if 'Uniqueid' in state:
+                self.uniqueids[state['Uniqueid']] = new
+            self._touch(new)
+
+        if self._hungup is not None:
+            self._hungup.add(old)
+        if self._touched is not None:
+            self._touched.discard(old)
+
+    def Link(self, manager, event):
+        one, two = str(event.Channel1), str(event.Channel2)
+        if one in self.channels:
+            self.channels[one]['Link'] = two
+            self._touch(one)
+        if two in self.channels:
+            self.channels[two]['Link'] = one
+            self._touch(two)
+
+    def Unlink(self, manager, event):
+        for key in ('Channel1', 'Channel2'):
+            name = str(event[key])
+            state = self.channels.get(name)
+            if state is not None:
+                state.pop('Link', None)
+                self._touch(name)
+
+    def Hangup(self, manager, event):
+        self._remove(str(event.Channel))
+
+    def Reconnect(self, manager, event):
+        # Events were missed while the connection was down.
+        self.refresh()
+
+
+    # Lookups.
+
+    def __getitem__(self, channel):
+        'Return the state of <channel>.'
+        return self.channels[str(channel)]
+
+    def __contains__(self, channel):
+        return str(channel) in self.channels
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __len__(self):
+        return len(self.channels)
+
+    def get(self, channel, default = None):
+        'Return the state of <channel>, or <default> if it is not active.'
+        return self.channels.get(str(channel), default)
+
+    def by_uniqueid(self, uniqueid):
+        'Return the name of the channel with <uniqueid>, or None.'
+        return self.uniqueids.get(uniqueid)
+
+    def items(self):
+        'Return a list of (name, state) tuples for every active channel.'
+        return self.channels.items()
+
+    def keys(self):
+        'Return a list of the names of every active channel.'
+        return self.channels.keys()
+
+
+
+
+class VariableCache(Asterisk.Logging.InstanceLogger):
+    '''
+    Cache of the channel variables read or written through a manager's
+    Getvar, Getvars, Setvar and Setvars methods, so values that have not
+    changed are returned without a Manager API round trip.
+
+    Only channels whose variables have been requested are tracked. Their
+    entries are kept current from VarSet events, and dropped when the channel
+    hangs up. VarSet events are sent under the 'dialplan' event class, so the
+    manager must receive them for the cache to be accurate.
+
+    Only ordinary variables are cached: those named in a VarSet event or
+    written through Setvar or Setvars, as only they are known to announce
+    their changes. Built-in variables such as EXTEN or HANGUPCAUSE, and
+    dialplan functions such as CDR(billsec) or DB(...), change without any
+    VarSet event, so they are always fetched from the PBX; <builtins> names
+    built-ins that are never cached even if they are seen set.
+    '''
+
+    builtins = frozenset([
+        'ACCOUNTCODE', 'ANSWEREDTIME', 'BLINDTRANSFER', 'BRIDGEPEER',
+        'CALLERID', 'CALLERIDNAME', 'CALLERIDNUM', 'CALLINGANI2',
+        'CALLINGPRES', 'CALLINGTNS', 'CALLINGTON', 'CHANNEL', 'CONTEXT',
+        'DATETIME', 'DIALEDPEERNAME', 'DIALEDPEERNUMBER', 'DIALEDTIME', 'DNID',
+        'EPOCH', 'EXTEN', 'HANGUPCAUSE', 'HINT', 'HINTNAME', 'INVALID_EXTEN',
+        'LANGUAGE', 'LEN', 'PRIORITY', 'RDNIS', 'SYSTEMNAME', 'TIMESTAMP',
+        'TRANSFER_CONTEXT', 'UNIQUEID',
+    ])
+
+    def __init__(self, manager):
+        '''
+        Cache variables read through BaseManager <manager>, registering our
+        event handlers with it.
+        '''
+
+        self.manager = manager
+        self.channels = {}
+        self.names = set()
+        self.hits = 0
+        self.misses = 0
+        self.log = self.getLogger()
+
+        self.events = Asterisk.Util.EventCollection([
+            self.VarSet, self.Rename, self.Hangup, self.Reconnect ])
+
+        manager.events += self.events
+        manager.variable_cache = self
+
+
+    def close(self):
+        'Unregister our event handlers from the manager.'
+
+        self.manager.events -= self.events
+        if self.manager.variable_cache is self:
+            self.manager.variable_cache = None
+
+
+    def lookup(self, channel, variable):
+        '''
+        Return the cached value of <channel>'s <variable>, None if it is known
+        to be unset, or Asterisk.Util.Unspecified if it is not cached.
+        '''
+
+        if not self.cacheable(variable):
+            return Asterisk.Util.Unspecified
+
+        value = self.channels.get(str(channel), {}).get(variable,
+            Asterisk.Util.Unspecified)
+
+        if value is Asterisk.Util.Unspecified:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+
+    def store(self, channel, variable, value):
+        'Record <value>, read from the PBX, as <channel>\'s <variable>.'
+
+        if self.cacheable(variable):
+            self.channels.setdefault(str(channel), {})[variable] = value
+
+
+    def assign(self, channel, variable, value):
+        'Record that <channel>\'s <variable> was set to <value> through Setvar.'
+
+        self._seen(variable)
+        self.store(channel, variable, value)
+
+
+    def _seen(self, variable):
+        'Note that <variable> is an ordinary variable, changed by VarSet.'
+
+        if '(' not in variable and variable not in self.builtins:
+            self.names.add(variable)
+
+
+    def cacheable(self, variable):
+        'Return truth if <variable> is known to be an ordinary variable.'
+        return variable in self.names
+
+
+    def clear(self):
+        'Discard every cached value.'
+        self.channels = {}
+
+
+    # Event handlers.
+
+    def VarSet(self, manager, event):
+        self._seen(event.Variable)
+        variables = self.channels.get(str(event.get('Channel')))
+        if variables is not None:
+            variables[event.Variable] = event.get('Value')
+
+    def Rename(self, manager, event):
+        old = str(event.get('Oldname') or event.get('Channel'))
+        variables = self.channels.pop(old, None)
+        if variables is not None:
+            self.channels[event.Newname] = variables
+
+    def Hangup(self, manager, event):
+        self.channels.pop(str(event.Channel), None)
+
+    def Reconnect(self, manager, event):
+        # Events were missed while the connection was down.
+        self.clear()
+
+
+
+
+def _location(event):
+    'Return the member interface named by a queue <event>.'
+
+    for key in ('Location', 'Interface', 'Member'):
+        if key in event:
+            return event[key]
+
+
+
+
+class QueueModel(Asterisk.Logging.InstanceLogger):
+    '''
+    In-memory model of the call queues on a PBX. The model is seeded once
+    from a QueueStatus action and then updated from queue member and caller
+    events, so wallboards may query it as often as they like.
+
+    Each queue is an AttributeDict of its parameters, as returned by
+    QueueStatus(), holding 'members' (keyed by interface) and 'entries'
+    (keyed by channel name) mappings. After every change the model fires
+    'QueueChanged' through <changes>, passing the model, the queue name, and
+    the event which caused the change.
+    '''
+
+    def __init__(self, manager, seed = True):
+        '''
+        Track queues on BaseManager <manager>, registering our event handlers
+        with it. If <seed> is True, load the current queue state with a
+        QueueStatus action.
+        '''
+
+        self.manager = manager
+        self.queues = {}
+        self.locations = {}
+        self.changes = Asterisk.Util.EventCollection()
+        self.log = self.getLogger()
+        self._touched = None
+
+        self.events = Asterisk.Util.EventCollection([
+            self.QueueMemberAdded, self.QueueMemberRemoved,
+            self.QueueMemberPaused, self.QueueMemberStatus, self.Join,
+            self.Leave, self.QueueCallerAbandon, self.AgentConnect,
+            self.AgentComplete, self.Reconnect ])
+
+        manager.events += self.events
+
+        if seed:
+            self.refresh()
+
+
+    def close(self):
+        'Unregister our event handlers from the manager.'
+        self.manager.events -= self.events
+
+
+    def refresh(self):
+        'Reload the queue model from a QueueStatus action.'
+
+        # Members, callers and counters changed by events while QueueStatus()
+        # runs must keep their newer state.
+        self._touched = set()
+
+        try:
+            snapshot = self.manager.QueueStatus()
+        finally:
+            touched, self._touched = self._touched, None
+
+        queues = {}
+
+        for name, queue in snapshot.iteritems():
+            queue = Asterisk.Util.AttributeDict(queue)
+            queue['members'] = dict(queue['members'])
+            queue['entries'] = dict([ (str(channel), entry)
+                for (channel, entry) in queue['entries'].iteritems() ])
+            queues[name] = queue
+
+        # Events are newer than the snapshot, so their state wins.
+        for kind, name, key in touched:
+            live = self.queues.get(name, {})
+
+            if kind == 'field':
+                if key in live:
+                    self._queue(name, queues)[key] = live[key]
+            elif key in live.get(kind, {}):
+                self._queue(name, queues)[kind][key] = live[kind][key]
+            elif name in queues:
+                queues[name][kind].pop(key, None)
+
+        locations = {}
+        for name, queue in queues.iteritems():
+            for location in queue['members']:
+                locations.setdefault(location, set()).add(name)
+
+        self.queues = queues
+        self.locations = locations
+
+
+    def _touch(self, kind, name, key):
+        '''
+        Note that <key> of queue <name> changed while a refresh is running.
+        <kind> is 'members', 'entries' or 'field'.
+        '''
+
+        if self._touched is not None:
+            self._touched.add((kind, name, key))
+
+
+    def _queue(self, name, queues = None):
+        if queues is None:
+            queues = self.queues
+
+        queue = queues.get(name)
+        if queue is None:
+            queue = queues[name] = Asterisk.Util.AttributeDict({
+                'members': {}, 'entries': {}
+            })
+        return queue
+
+
+    def _changed(self, name, event):
+        self.changes.fire('QueueChanged', self, name, event)
+
+
+    @staticmethod
+    def _fields(event, *exclude):
+        return [ (k, v) for (k, v) in event.iteritems()
+            if k not in _EVINFO_KEYS and k not in exclude ]
+
+
+    # Event handlers.
+
+    def QueueMemberAdded(self, manager, event):
+        name, location = event.Queue, _location(event)
+        member = Asterisk.Util.AttributeDict(self._fields(event, 'Queue', 'Location'))
+        self._queue(name)['members'][location] = member
+        self.locations.setdefault(location, set()).add(name)
+        self._touch('members', name, location)
+        self._changed(name, event)
+
+    def QueueMemberRemoved(self, manager, event):
+        name, location = event.Queue, _location(event)
+        self._queue(name)['members'].pop(location, None)
+        queues = self.locations.get(location)
+        if queues is not None:
+            queues.discard(name)
+            if not queues:
+                del self.locations[location]
+        self._touch('members', name, location)
+        self._changed(name, event)
+
+    def _update_member(self, event, fields):
+        name, location = event.Queue, _location(event)
+        member = self._queue(name)['members'].get(location)
+        if member is None:
+            self.log.debug('Event for unknown queue member: %r', event)
+            return
+        member.update(fields)
+        self._touch('members', name, location)
+        self._changed(name, event)
+
+    def QueueMemberPaused(self, manager, event):
+        self._update_member(event, [ ('Paused', event.Paused) ])
+
+    def QueueMemberStatus(self, manager, event):
+        self._update_member(event, self._fields(event, 'Queue', 'Location'))
+
+    def AgentConnect(self, manager, event):
+        self._update_member(event, [ ('InCall', '1') ])
+
+    def AgentComplete(self, manager, event):
+        self._update_member(event, [ ('InCall', '0') ])
+
+    def Join(self, manager, event):
+        name, channel = event.Queue, str(event.Channel)
+        queue = self._queue(name)
+        queue['entries'][channel] = Asterisk.Util.AttributeDict(
+            self._fields(event, 'Queue', 'Channel', 'Count'))
+        self._touch('entries', name, channel)
+        if 'Count' in event:
+            queue['Calls'] = event.Count
+            self._touch('field', name, 'Calls')
+        self._changed(name, event)
+
+    def Leave(self, manager, event):
+        name, channel = event.Queue, str(event.Channel)
+        queue = self._queue(name)
+        entry = queue['entries'].pop(channel, None)
+        self._touch('entries', name, channel)
+
+        if entry is not None and 'Position' in entry:
+            position = int(entry['Position'])
+            for other, state in queue['entries'].iteritems():
+                if int(state.get('Position', 0)) > position:
+                    state['Position'] = str(int(state['Position']) - 1)
+                    self._touch('entries', name, other)
+
+        if 'Count' in event:
+            queue['Calls'] = event.Count
+            self._touch('field', name, 'Calls')
+        self._changed(name, event)
+
+    def QueueCallerAbandon(self, manager, event):
+        queue = self._queue(event.Queue)
+        queue['Abandoned'] = str(int(queue.get('Abandoned', 0)) + 1)
+        self._touch('field', event.Queue, 'Abandoned')
+        self._changed(event.Queue, event)
+
+    def Reconnect(self, manager, event):
+        # Events were missed while the connection was down.
+        self.refresh()
+        for name in self.queues:
+            self._changed(name, event)
+
+
+    # Queries.
+
+    def __getitem__(self, name):
+        'Return the queue named <name>.'
+        return self.queues[name]
+
+    def __contains__(self, name):
+        return name in self.queues
+
+    def __iter__(self):
+        return iter(self.queues)
+
+    def __len__(self):
+        return len(self.queues)
+
+    def members(self, name):
+        'Return the mapping of interface to member state for queue <name>.'
+        return self.queues[name]['members']
+
+    def member(self, name, location):
+        'Return the state of member <location> in queue <name>.'
+        return self.queues[name]['members'][location]
+
+    def entries(self, name):
+        'Return the callers waiting in queue <name>, ordered by position.'
+
+        entries = self.queues[name]['entries'].items()
+        entries.sort(key = lambda item: int(item[1].get('Position', 0)))
+        return entries
+
+    def member_queues(self, location):
+        'Return the names of the queues interface <location> is a member of.'
+        return sorted(self.locations.get(location, ()))
+
+
+
+
+# Extension states reported by ExtensionStatus events, named as in the
+# output of 'core show hints'.
+
+EXTENSION_STATES = {
+    '-2': None,
+    '-1': None,
+    '0': 'Idle',
+    '1': 'InUse',
+    '2': 'Busy',
+    '4': 'Unavailable',
+    '8': 'Ringing',
+    '9': 'InUse&Ringing',
+    '16': 'Hold',
+    '17': 'InUse&Hold',
+}
+
+
+
+
+class HintTable(Asterisk.Logging.InstanceLogger):
+    '''
+    In-memory table of the hint states on a PBX, for busy lamp fields and
+    presence displays. The table is seeded once from ExtensionStates() and
+    then updated from ExtensionStatus events, so lookups never touch the
+    Manager API.
+
+    The table acts as a read-only mapping of context name to a dict of
+    extension to state, as returned by ExtensionStates(). After every change
+    it fires 'HintChanged' through <changes>, passing the table, the context,
+    the extension and its new state, or None if the hint was removed.
+    '''
+
+    def __init__(self, manager, seed = True):
+        '''
+        Track hints on BaseManager <manager>, registering our event handlers
+        with it. If <seed> is True, load the current hint states with a
+        'core show hints' command.
+        '''
+
+        self.manager = manager
+        self.contexts = {}
+        self.changes = Asterisk.Util.EventCollection()
+        self.log = self.getLogger()
+        self._touched = None
+
+        self.events = Asterisk.Util.EventCollection([
+            self.ExtensionStatus, self.Reconnect ])
+
+        manager.events += self.events
+
+        if seed:
+            self.refresh()
+
+
+    def close(self):
+        'Unregister our event handlers from the manager.'
+        self.manager.events -= self.events
+
+
+    def refresh(self):
+        'Reload the hint table from the output of ExtensionStates().'
+
+        # Hints changed by events while ExtensionStates() runs must keep
+        # their newer state.
+        self._touched = set()
+
+        try:
+            contexts = self.manager.ExtensionStates()
+        finally:
+            touched, self._touched = self._touched, None
+
+        for context, extension in touched:
+            state = self.contexts.get(context, {}).get(extension)
+            if state is not None:
+                contexts.setdefault(context, {})[extension] = state
+            elif context in contexts:
+                contexts[context].pop(extension, None)
+                if not contexts[context]:
+                    del contexts[context]
+
+        self.contexts = contexts
+
+
+    # Event handlers.
+
+    def ExtensionStatus(self, manager, event):
+        context, extension = event.Context, event.Exten
+        status = event.Status
+        state = EXTENSION_STATES.get(status, 'Unknown')
+
+        if state is None:
+            extensions = self.contexts.get(context)
+            if extensions is not None:
+                extensions.pop(extension, None)
+                if not extensions:
+                    del self.contexts[context]
+        else:
+            self.contexts.setdefault(context, {})[extension] = state
+
+        if self._touched is not None:
+            self._touched.add((context, extension))
+
+        self.changes.fire('HintChanged', self, context, extension, state)
+
+    def Reconnect(self, manager, event):
+        # Events were missed while the connection was down.
+        self.refresh()
+
+
+    # Lookups.
+
+    def __getitem__(self, context):
+        'Return the dict of extension states in <context>.'
+        return self.contexts[context]
+
+    def __contains__(self, context):
+        return context in self.contexts
+
+    def __iter__(self):
+        return iter(self.contexts)
+
+    def __len__(self):
+        return len(self.contexts)
+
+    def state(self, extension, context = 'default', default = None):
+        'Return the state of <extension> in <context>, or <default>.'
+        return self.contexts.get(context, {}).get(extension, default)
+
+
+
+
+class MeetMeModel(Asterisk.Logging.InstanceLogger):
+    '''
+    In-memory model of the MeetMe conferences on a PBX. The model is seeded
+    once from MeetMe() and MeetMeList() and then updated from MeetmeJoin and
+    MeetmeLeave events, so conference listings never touch the Manager API.
+
+    Each conference is an AttributeDict of its fields, as returned by
+    MeetMe(), holding a 'users' mapping of user number to the user's fields,
+    as returned by MeetMeList(). Conferences are removed when their last user
+    leaves, as they are from the 'meetme' command output. After every change
+    the model fires 'ConferenceChanged' through <changes>, passing the model,
+    the conference number, and the event which caused the change.
+    '''
+
+    def __init__(self, manager, seed = True):
+        '''
+        Track conferences on BaseManager <manager>, registering our event
+        handlers with it. If <seed> is True, load the current conferences and
+        their users with 'meetme' commands.
+        '''
+
+        self.manager = manager
+        self.conferences = {}
+        self.changes = Asterisk.Util.EventCollection()
+        self.log = self.getLogger()
+        self._touched = None
+
+        self.events = Asterisk.Util.EventCollection([
+            self.MeetmeJoin, self.MeetmeLeave, self.Reconnect ])
+
+        manager.events += self.events
+
+        if seed:
+            self.refresh()
+
+
+    def close(self):
+        'Unregister our event handlers from the manager.'
+        self.manager.events -= self.events
+
+
+    def refresh(self):
+        'Reload the conference model from MeetMe() and MeetMeList().'
+
+        # Users who joined or left while the 'meetme' commands run must keep
+        # their newer state.
+        self._touched = set()
+
+        try:
+            conferences = {}
+
+            for conference in self.manager.MeetMe():
+                conference = Asterisk.Util.AttributeDict(conference)
+                conference['users'] = dict([ (str(int(user['usernum'])), user)
+                    for user in self.manager.MeetMeList(conference['confnum']) ])
+                conferences[conference['confnum']] = conference
+        finally:
+            touched, self._touched = self._touched, None
+
+        for confnum, usernum in touched:
+            live = self.conferences.get(confnum)
+            conference = conferences.get(confnum)
+
+            if live is not None and usernum in live['users']:
+                if conference is None:
+                    conference = conferences[confnum] = Asterisk.Util.AttributeDict(live)
+                    conference['users'] = {}
+                conference['users'][usernum] = live['users'][usernum]
+            elif conference is not None:
+                conference['users'].pop(usernum, None)
+
+        for confnum in set([ confnum for (confnum, usernum) in touched ]):
+            conference = conferences.get(confnum)
+            if conference is None:
+                continue
+            if conference['users']:
+                conference['parties'] = str(len(conference['users']))
+            else:
+                del conferences[confnum]
+
+        self.conferences = conferences
+
+
+    def _touch(self, confnum, usernum):
+        'Note that user <usernum> of <confnum> changed while a refresh runs.'
+
+        if self._touched is not None:
+            self._touched.add((confnum, usernum))
+
+
+    def _changed(self, confnum, event):
+        self.changes.fire('ConferenceChanged', self, confnum, event)
+
+
+    # Event handlers.
+
+    def MeetmeJoin(self, manager, event):
+        confnum, usernum = event.Meetme, str(int(event.Usernum))
+        conference = self.conferences.get(confnum)
+
+        if conference is None:
+            conference = self.conferences[confnum] = Asterisk.Util.AttributeDict({
+                'confnum': confnum, 'users': {}
+            })
+
+        callerid = ' '.join([ event[key] for key in ('CallerIDnum', 'CallerIDname')
+            if event.get(key) ])
+
+        conference['users'][usernum] = {
+            'usernum': usernum,
+            'callerid': callerid,
+            'channel': str(event.Channel),
+        }
+        conference['parties'] = str(len(conference['users']))
+        self._touch(confnum, usernum)
+        self._changed(confnum, event)
+
+    def MeetmeLeave(self, manager, event):
+        confnum, usernum = event.Meetme, str(int(event.Usernum))
+        self._touch(confnum, usernum)
+
+        conference = self.conferences.get(confnum)
+        if conference is None:
+            return
+
+        conference['users'].pop(usernum, None)
+        if conference['users']:
+            conference['parties'] = str(len(conference['users']))
+        else:
+            del self.conferences[confnum]
+        self._changed(confnum, event)
+
+    def Reconnect(self, manager, event):
+        # Events were missed while the connection was down.
+        self.refresh()
+        for confnum in self.conferences:
+            self._changed(confnum, event)
+
+
+    # Queries.
+
+    def __getitem__(self, confnum):
+        'Return the conference numbered <confnum>.'
+        return self.conferences[confnum]
+
+    def __contains__(self, confnum):
+        return confnum in self.conferences
+
+    def __iter__(self):
+        return iter(self.conferences)
+
+    def __len__(self):
+        return len(self.conferences)
+
+    def users(self, confnum):
+        'Return the mapping of user number to user fields for <confnum>.'
+        return self.conferences[confnum]['users']
@@ -0,0 +1,369 @@
+'''
+Asterisk/Threaded.py: Manager API sessions shared between threads.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import socket, threading, Queue
+import Asterisk.Executor
+from Asterisk.Manager import BaseManager, CoreActions, ZapataActions, \
+    CommunicationError, InternalError, GoneAwayError
+
+
+
+
+class ThreadedManager(BaseManager):
+    '''
+    Base protocol implementation for a Manager API session that may be used
+    from many threads at once.
+
+    A reader thread owns the socket. Responses, and list events carrying an
+    ActionID, are routed to the thread that sent the action, so the blocking
+    CoreActions methods may be called concurrently. ActionFuture callbacks
+    run on the reader thread, so they must not call the blocking methods,
+    which raise InternalError there; they may use send_action(). Handlers of
+    events carrying the ActionID of such an action, like OriginateResponse,
+    run there too. Other events are passed to on_Event through <executor>, so slow handlers never
+    hold up reading; events for the same channel are still handled in the
+    order they arrived.
+    '''
+
+    def __init__(self, address, username, secret, listen_events = True,
+            timeout = None, event_mask = None, lazy_events = False,
+            compact_packets = False, executor = None):
+        '''
+        Connect and authenticate as for BaseManager, then start the reader
+        thread. Events are run by calling <executor>.submit(func, *args), or
+        by a single worker Asterisk.Executor.OrderedExecutor if None.
+
+        submit() is called from the reader thread, so it must not block: a
+        handler waiting on an action's response would otherwise stall the
+        reader that delivers it. The default executor therefore drops events
+        when its queue is full, and a custom <executor> should use the
+        'drop' or 'raise' overflow policy.
+        '''
+
+        self.lock = threading.RLock()
+        self.send_lock = threading.Lock()
+        self.local = threading.local()
+        self.streams = {}
+        self.thread = None
+        self.closed = False
+        self.failure = None
+
+        if executor is None:
+            executor = self.own_executor = Asterisk.Executor.OrderedExecutor(1,
+                overflow = 'drop')
+        else:
+            self.own_executor = None
+        self.executor = executor
+
+        BaseManager.__init__(self, address, username, secret,
+            listen_events = listen_events, timeout = timeout,
+            event_mask = event_mask, lazy_events = lazy_events,
+            compact_packets = compact_packets)
+
+        # The reader thread blocks until data arrives; <timeout> applies to
+        # callers waiting for responses instead.
+        self.sock.settimeout(None)
+
+        self.thread = threading.Thread(target = self._run,
+            name = 'Asterisk reader for %s:%d' % tuple(address))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+    def _send(self, text):
+        'Send the formatted request <text>, one thread at a time.'
+
+        if self.closed:
+            raise GoneAwayError('Asterisk Manager connection has gone away.')
+
+        self.send_lock.acquire()
+        try:
+            BaseManager._send(self, text)
+        finally:
+            self.send_lock.release()
+
+
+    def _write_action(self, action, data = None):
+        '''
+        Write an <action> request, arranging for packets carrying its
+        ActionID to be routed to the calling thread. Return the action
+        identifier.
+        '''
+
+        if self.thread is None:
+            return BaseManager._write_action(self, action, data)
+
+        id, text = self._format_action(action, data)
+        previous = getattr(self.local, 'stream', None)
+
+        self.lock.acquire()
+        try:
+            if previous is not None:
+                self.streams.pop(previous, None)
+            self.streams[id] = Queue.Queue()
+        finally:
+            self.lock.release()
+
+        self.local.stream = id
+
+        if self.log_io:
+            self.log.io('_write_action: send %r', text)
+        self._send(text)
+        return id
+
+
+    def _get(self, id):
+        'Return the next packet routed to action <id>.'
+
+        stream = self.streams.get(id)
+        if stream is None:
+            if self.failure is not None:
+                raise self.failure
+            raise InternalError('no action %r in progress.' % (id,))
+
+        try:
+            packet = stream.get(True, self.timeout)
+        except Queue.Empty:
+            raise socket.timeout('timed out')
+
+        if isinstance(packet, Exception):
+            raise packet
+
+        return packet
+
+
+    def _read_packet(self, discard_events = False):
+        '''
+        Return the next packet. On the reader thread this reads the socket;
+        other threads receive packets for the last action they wrote.
+        '''
+
+        if self.thread is None or threading.currentThread() is self.thread:
+            return BaseManager._read_packet(self, discard_events)
+
+        id = getattr(self.local, 'stream', None)
+
+        while True:
+            packet = self._get(id)
+            if discard_events and 'Event' in packet:
+                continue
+            return packet
+
+
+    def read_response(self, id, more = False):
+        '''
+        Return the response packet found for the given action <id>. Unless
+        <more> is True, packets for <id> are no longer routed to the calling
+        thread once it has been read.
+        '''
+
+        if self.thread is None:
+            return BaseManager.read_response(self, id, more)
+
+        if threading.currentThread() is self.thread:
+            # Only the reader thread fills our streams, so waiting here
+            # would never return.
+            self._action_done(id)
+            raise InternalError('blocking actions cannot be called from the '
+                'reader thread; use send_action() instead.')
+
+        try:
+            while True:
+                packet = self._get(id)
+
+                if 'Response' in packet and 'Event' not in packet:
+                    break
+
+                self._submit_event(packet)
+        except Exception:
+            self._action_done(id)
+            raise
+
+        if not more:
+            self._action_done(id)
+
+        if self.metrics is not None:
+            self.metrics.action_completed(id)
+        packet.pop('ActionID')
+        return packet
+
+
+    def _action_done(self, id):
+        '''
+        Stop routing packets for action <id> to the thread that sent it, and
+        dispatch any it left unread.
+        '''
+
+        self.lock.acquire()
+        try:
+            stream = self.streams.pop(id, None)
+            leftover = []
+            while stream is not None and not stream.empty():
+                leftover.append(stream.get())
+        finally:
+            self.lock.release()
+
+        if getattr(self.local, 'stream', None) == id:
+            self.local.stream = None
+
+        for packet in leftover:
+            if isinstance(packet, Exception):
+                continue
+            if 'Response' in packet and 'Event' not in packet:
+                self.lock.acquire()
+                try:
+                    self._dispatch_packet(packet)
+                finally:
+                    self.lock.release()
+            else:
+                self._submit_event(packet)
+
+
+    def _submit_event(self, event):
+        'Pass <event> to on_Event through the executor.'
+
+        self._translate_event(event)
+        self.executor.submit(self.on_Event, event)
+
+
+    def _run(self):
+        'Reader thread: route every packet read until the connection ends.'
+
+        reader = self.reader
+
+        try:
+            while True:
+                packet = reader.read_packet()
+                if self.log_packet:
+                    self.log.packet('_read_packet: %r', packet)
+
+                if 'ActionID' in packet and self._route(packet):
+                    continue
+
+                # Events answering an action, such as OriginateResponse, are
+                # handled here like responses, so they are never dropped or
+                # held up behind other events by the executor.
+                if 'ActionID' in packet or 'Event' not in packet:
+                    self.lock.acquire()
+                    try:
+                        self._dispatch_packet(packet)
+                    finally:
+                        self.lock.release()
+
+                else:
+                    self._submit_event(packet)
+
+        except Exception, e:
+            if self.closed:
+                e = GoneAwayError('Asterisk Manager connection closed.')
+            elif not isinstance(e, GoneAwayError):
+                self.log.exception('Error reading from Manager connection.')
+            self._fail(e)
+
+
+    def _route(self, packet):
+        '''
+        Pass <packet> to the thread reading packets for its action, returning
+        True if there is one. The lock is held so that a stream dropped by
+        _action_done() never receives a packet afterwards.
+        '''
+
+        self.lock.acquire()
+        try:
+            stream = self.streams.get(packet['ActionID'])
+            if stream is not None:
+                stream.put(packet)
+            return stream is not None
+        finally:
+            self.lock.release()
+
+
+    def _fail(self, exception):
+        'Fail every outstanding action and waiting thread with <exception>.'
+
+        self.lock.acquire()
+        try:
+            self.closed = True
+            self.failure = exception
+
+            futures = self.futures.values()
+            self.futures.clear()
+            for future in futures:
+                future.set_exception(exception)
+
+            streams = self.streams.values()
+            for stream in streams:
+                stream.put(exception)
+        finally:
+            self.lock.release()
+
+
+    def wait(self, future):
+        'Block until <future> is resolved by the reader thread.'
+
+        if self.thread is None or threading.currentThread() is self.thread:
+            return BaseManager.wait(self, future)
+
+        done = threading.Event()
+
+        self.lock.acquire()
+        try:
+            future.add_callback(lambda future: done.set())
+        finally:
+            self.lock.release()
+
+        if not done.wait(self.timeout):
+            raise socket.timeout('timed out')
+
+
+    def close(self):
+        'Log off, close the connection and stop our threads.'
+
+        if not self.closed:
+            self.log.debug('Closing down.')
+
+            self._write_action('Logoff')
+            try:
+                packet = self._read_packet(discard_events = True)
+            finally:
+                self.closed = True
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+                self.sock.close()
+
+            if packet.Response != 'Goodbye':
+                raise CommunicationError(packet, 'expected goodbye')
+
+        if threading.currentThread() is not self.thread:
+            self.thread.join()
+        if self.own_executor is not None:
+            self.own_executor.shutdown()
+
+
+    def read(self):
+        'Provided for compatibility with BaseManager; the reader thread reads.'
+        pass
+
+
+    def serve_forever(self):
+        'Block until the connection ends, then raise the reason.'
+
+        self.thread.join()
+        raise self.failure
+
+
+
+
+class ThreadedCoreManager(ThreadedManager, CoreActions, ZapataActions):
+    '''
+    Asterisk Manager API protocol implementation and core actions for a
+    session shared between threads.
+    '''
+
+    pass
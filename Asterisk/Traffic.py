@@ -0,0 +1,328 @@
+'''
+Asterisk/Traffic.py: rolling traffic statistics from Hangup events.
+
+A HangupStats instance follows channels from Newchannel to Hangup, and adds
+each hung up channel to rolling windows counted per hangup cause, per
+channel prefix (see channel_prefix(), which usually names the trunk or
+device) and per dialplan context. From the counts it reports:
+
+    calls       Channels hung up within the window (seizures).
+    answered    Those that were answered.
+    asr         Answer-seizure ratio: answered / calls.
+    acd         Average call duration: answered seconds / answered.
+    rate        Calls per second over the window.
+
+Counts are held in flat arrays with one row per key and one column per time
+slot, so recording a call costs a few array increments whatever the call
+rate, and no per-call objects outlive the call.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import threading, time, array, collections
+import Asterisk, Asterisk.Util, Asterisk.Logging
+
+
+
+
+class RollingWindow(object):
+    '''
+    Counts of calls, answers and answered seconds per key over the last
+    <slots> time slots of <width> seconds each.
+    '''
+
+    def __init__(self, slots = 60, width = 1.0):
+        self.slots = slots
+        self.width = float(width)
+        self.keys = {}
+        self.epochs = array.array('l', [ -1 ] * slots)
+        self.calls = array.array('l')
+        self.answered = array.array('l')
+        self.seconds = array.array('d')
+
+
+    def _row(self, key):
+        'Return the row offset of <key>, adding a row if it is new.'
+
+        row = self.keys.get(key)
+        if row is None:
+            row = self.keys[key] = len(self.calls)
+            self.calls.extend([ 0 ] * self.slots)
+            self.answered.extend([ 0 ] * self.slots)
+            self.seconds.extend([ 0.0 ] * self.slots)
+        return row
+
+
+    def _slot(self, now):
+        'Return the column for time <now>, clearing it if it has rolled over.'
+
+        epoch = int(now / self.width)
+        column = epoch % self.slots
+
+        if self.epochs[column] != epoch:
+            self.epochs[column] = epoch
+            calls, answered, seconds = self.calls, self.answered, self.seconds
+            for offset in xrange(column, len(calls), self.slots):
+                calls[offset] = 0
+                answered[offset] = 0
+                seconds[offset] = 0.0
+
+        return column
+
+
+    def add(self, key, duration, now):
+        '''
+        Count a call for <key> ending at <now>, answered for <duration>
+        seconds, or not answered if <duration> is None.
+        '''
+
+        offset = self._row(key) + self._slot(now)
+        self.calls[offset] += 1
+        if duration is not None:
+            self.answered[offset] += 1
+            self.seconds[offset] += duration
+
+
+    def _columns(self, now):
+        'Return the columns holding counts from within the window.'
+
+        oldest = int(now / self.width) - self.slots
+        return [ column for (column, epoch) in enumerate(self.epochs)
+            if epoch > oldest ]
+
+
+    def totals(self, now = None):
+        'Return a dict of (calls, answered, seconds) totals by key.'
+
+        if now is None:
+            now = time.time()
+
+        columns = self._columns(now)
+        calls, answered, seconds = self.calls, self.answered, self.seconds
+        totals = {}
+
+        for key, row in self.keys.iteritems():
+            offsets = [ row + column for column in columns ]
+            totals[key] = (
+                sum([ calls[offset] for offset in offsets ]),
+                sum([ answered[offset] for offset in offsets ]),
+                sum([ seconds[offset] for offset in offsets ]),
+            )
+
+        return totals
+
+
+    def series(self, key, now = None):
+        '''
+        Return a list of the call counts for <key> in each slot of the
+        window, oldest first.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        row = self.keys.get(key)
+        current = int(now / self.width)
+        series = []
+
+        for epoch in xrange(current - self.slots + 1, current + 1):
+            column = epoch % self.slots
+            if row is None or self.epochs[column] != epoch:
+                series.append(0)
+            else:
+                series.append(self.calls[row + column])
+
+        return series
+
+
+
+
+def channel_prefix(channel):
+    '''
+    Return the name of <channel> up to its last '-' and without any dialled
+    number, eg. 'SIP/trunk1' for 'SIP/trunk1-000004a2', or 'DAHDI/i1' for
+    'DAHDI/i1/5551234-1'.
+    '''
+
+    name = str(channel)
+    idx = name.rfind('-')
+    if idx > 0:
+        name = name[:idx]
+    return '/'.join(name.split('/', 2)[:2])
+
+
+
+
+class HangupStats(Asterisk.Logging.InstanceLogger):
+    '''
+    Rolling answer-seizure ratio, average call duration and hangup cause
+    statistics for the channels on a PBX, computed from Newchannel, Newexten,
+    Newstate and Hangup events.
+
+    Only the start time, answer time and context of each channel in progress
+    are remembered, in one tuple per channel; at most <max_channels> are
+    tracked. Channels already up when tracking started are not counted.
+
+    Each distinct key costs a row of 3 * <slots> array entries, so <prefix>
+    should not return keys holding dialled numbers.
+
+    Our state is only changed under a lock, so the event handlers may run on
+    several executor workers at once.
+    '''
+
+    def __init__(self, manager, slots = 60, width = 1.0, max_channels = 100000,
+            prefix = channel_prefix):
+        '''
+        Count the calls of BaseManager <manager> over windows of <slots> slots
+        of <width> seconds, registering our event handlers with it. <prefix>
+        is called with each channel name to return the key it is counted
+        under.
+        '''
+
+        self.manager = manager
+        self.slots = slots
+        self.width = width
+        self.max_channels = max_channels
+        self.prefix = prefix
+        self.log = self.getLogger()
+
+        self.lock = threading.Lock()
+        self.channels = collections.OrderedDict()
+        self.causes = RollingWindow(slots, width)
+        self.prefixes = RollingWindow(slots, width)
+        self.contexts = RollingWindow(slots, width)
+        self.total = RollingWindow(slots, width)
+
+        self.events = Asterisk.Util.EventCollection([
+            self.Newchannel, self.Newexten, self.Newstate, self.Hangup ])
+
+        manager.events += self.events
+
+
+    def close(self):
+        'Unregister our event handlers from the manager.'
+        self.manager.events -= self.events
+
+
+    # Event handlers.
+
+    def Newchannel(self, manager, event):
+        channels = self.channels
+
+        self.lock.acquire()
+        try:
+            channels[event.Uniqueid] = (time.time(), None, event.get('Context') or None)
+
+            if len(channels) > self.max_channels:
+                channels.popitem(last = False)
+        finally:
+            self.lock.release()
+
+    def Newexten(self, manager, event):
+        uniqueid = event.get('Uniqueid')
+
+        self.lock.acquire()
+        try:
+            state = self.channels.get(uniqueid)
+            if state is not None and state[2] is None:
+                self.channels[uniqueid] = state[:2] + (event.get('Context'),)
+        finally:
+            self.lock.release()
+
+    def Newstate(self, manager, event):
+        uniqueid = event.get('Uniqueid')
+        status = event.get('ChannelStateDesc') or event.get('State')
+        if status != 'Up':
+            return
+
+        self.lock.acquire()
+        try:
+            state = self.channels.get(uniqueid)
+            if state is not None and state[1] is None:
+                self.channels[uniqueid] = (state[0], time.time(), state[2])
+        finally:
+            self.lock.release()
+
+    def Hangup(self, manager, event):
+        try:
+            cause = int(event.get('Cause'))
+        except (TypeError, ValueError):
+            cause = 0
+
+        prefix = self.prefix(event.Channel)
+
+        self.lock.acquire()
+        try:
+            state = self.channels.pop(event.get('Uniqueid'), None)
+            if state is None:
+                return
+
+            now = time.time()
+            started, answered, context = state
+            duration = None
+            if answered is not None:
+                duration = now - answered
+
+            self.causes.add(cause, duration, now)
+            self.prefixes.add(prefix, duration, now)
+            self.contexts.add(context or '', duration, now)
+            self.total.add(None, duration, now)
+        finally:
+            self.lock.release()
+
+
+    # Reporting.
+
+    def _report(self, window, now):
+        seconds = window.slots * window.width
+        report = {}
+
+        for key, (calls, answered, total) in window.totals(now).iteritems():
+            report[key] = {
+                'calls': calls,
+                'answered': answered,
+                'asr': calls and float(answered) / calls or 0.0,
+                'acd': answered and total / answered or 0.0,
+                'rate': calls / seconds,
+            }
+
+        return report
+
+
+    def snapshot(self, now = None):
+        '''
+        Return a dict of the statistics over the current window: 'total',
+        and dicts keyed by 'causes', 'prefixes' and 'contexts'. Cause
+        statistics also give the cause 'name' and 'description' from
+        Asterisk.cause_codes.
+        '''
+
+        if now is None:
+            now = time.time()
+
+        self.lock.acquire()
+        try:
+            causes = self._report(self.causes, now)
+            total = self._report(self.total, now).get(None) or {
+                'calls': 0, 'answered': 0, 'asr': 0.0, 'acd': 0.0, 'rate': 0.0 }
+            total['active'] = len(self.channels)
+            prefixes = self._report(self.prefixes, now)
+            contexts = self._report(self.contexts, now)
+        finally:
+            self.lock.release()
+
+        for code, report in causes.iteritems():
+            code, name, description = Asterisk.cause_codes.get(code,
+                (code, 'UNKNOWN', 'Unknown cause'))
+            report['name'] = name
+            report['description'] = description
+
+        return {
+            'time': now,
+            'window': self.slots * self.width,
+            'total': total,
+            'causes': causes,
+            'prefixes': prefixes,
+            'contexts': contexts,
+        }
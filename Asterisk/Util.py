@@ -5,7 +5,7 @@ Asterisk/Util.py: utility classes.
 __author__ = 'David Wilson'
 __Id__ = '$Id$'
 
-import sys, copy
+import sys, copy, fnmatch, time
 import Asterisk
 from Asterisk import Logging
 
@@ -44,11 +44,217 @@ class AttributeDict(dict):
     def copy(self):
         return AttributeDict(self.iteritems())
 
+    @classmethod
+    def from_lists(cls, keys, values):
+        'Return a new instance mapping the list <keys> to the list <values>.'
+        return cls(zip(keys, values))
+
+
+
+
+# Key tuples shared by every Packet with the same set of headers. The number of
+# distinct shapes seen on a Manager connection is small, but the table is
+# bounded in case of a misbehaving peer.
+
+_shapes = {}
+_MAX_SHAPES = 4096
+
+# Headers whose values are drawn from a small set, and so are worth interning.
+
+_INTERNED_VALUES = frozenset([ 'Event', 'Privilege', 'Response', 'State',
+    'ChannelState', 'ChannelStateDesc', 'Context', 'Status', 'Cause-txt' ])
+
+
+def _shape(keys):
+    'Return the shared, interned tuple equal to the sequence <keys>.'
+
+    keys = tuple(keys)
+    shape = _shapes.get(keys)
+
+    if shape is None:
+        shape = tuple([ intern(key) for key in keys ])
+        if len(_shapes) < _MAX_SHAPES:
+            _shapes[shape] = shape
+
+    return shape
+
+
+
+
+class Packet(object):
+    '''
+    Compact replacement for AttributeDict, used for packets when a Manager is
+    created with compact_packets=True. Header names are held in a tuple
+    shared by every packet with the same headers, and values in a second
+    tuple, so a retained packet costs a fraction of a dict. The mapping and
+    attribute interfaces of AttributeDict are supported; updates are slower,
+    as they rebuild the tuples.
+    '''
+
+    __slots__ = ('_keys', '_values')
+
+    def __init__(self, items = ()):
+        if hasattr(items, 'keys'):
+            items = [ (key, items[key]) for key in items.keys() ]
+
+        merged = dict(items)
+        self._set(merged.keys(), merged.values())
+
+
+    @classmethod
+    def from_lists(cls, keys, values):
+        'Return a new instance mapping the list <keys> to the list <values>.'
+
+        packet = cls.__new__(cls)
+
+        if len(set(keys)) != len(keys):
+            merged = dict(zip(keys, values))
+            keys, values = merged.keys(), merged.values()
+
+        packet._set(keys, values)
+        return packet
+
+
+    def _set(self, keys, values):
+        keys = _shape(keys)
+        values = list(values)
+
+        for idx, key in enumerate(keys):
+            if key in _INTERNED_VALUES and type(values[idx]) is str:
+                values[idx] = intern(values[idx])
+
+        object.__setattr__(self, '_keys', keys)
+        object.__setattr__(self, '_values', tuple(values))
+
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        keys, values = list(self._keys), list(self._values)
+        try:
+            values[keys.index(key)] = value
+        except ValueError:
+            keys.append(key)
+            values.append(value)
+        self._set(keys, values)
+
+    def __delitem__(self, key):
+        keys, values = list(self._keys), list(self._values)
+        try:
+            idx = keys.index(key)
+        except ValueError:
+            raise KeyError(key)
+        del keys[idx], values[idx]
+        self._set(keys, values)
+
+    def __getattr__(self, key):
+        if key[:1] == '_':
+            raise AttributeError(key)
+        return self[key]
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __eq__(self, other):
+        try:
+            return dict(self.iteritems()) == dict(other.items())
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def __getstate__(self):
+        return (self._keys, self._values)
+
+    def __setstate__(self, state):
+        self._set(*state)
+
+    def get(self, key, default = None):
+        try:
+            return self._values[self._keys.index(key)]
+        except ValueError:
+            return default
+
+    def pop(self, key, default = Unspecified):
+        try:
+            value = self[key]
+        except KeyError:
+            if default is Unspecified:
+                raise
+            return default
+        del self[key]
+        return value
+
+    def setdefault(self, key, default = None):
+        if key not in self._keys:
+            self[key] = default
+        return self[key]
+
+    def update(self, other):
+        merged = dict(self.iteritems())
+        merged.update(other)
+        self._set(merged.keys(), merged.values())
+
+    def clear(self):
+        self._set((), ())
+
+    def copy(self):
+        new = Packet.__new__(Packet)
+        object.__setattr__(new, '_keys', self._keys)
+        object.__setattr__(new, '_values', self._values)
+        return new
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self._values)
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+    def iterkeys(self):
+        return iter(self._keys)
+
+    def itervalues(self):
+        return iter(self._values)
+
+    def iteritems(self):
+        return iter(zip(self._keys, self._values))
+
 
 
 class EventCollection(Logging.InstanceLogger):
     '''
     Utility class to allow grouping and automatic registration of event.
+
+    Handlers may be subscribed to an exact event name, or to a shell-style
+    wildcard pattern such as 'Queue*' or '*'. They may also be restricted to
+    events carrying particular header values, eg. { 'Queue': 'sales' }, or
+    passing a <predicate> test; such handlers are only called by
+    fire_event(). The handlers interested in each event name are worked out
+    once and cached until the subscriptions change, and header restrictions
+    are looked up through an index on the header value, so an event only
+    reaches the handlers that care about it.
     '''
 
     def __init__(self, initial = None):
@@ -58,37 +264,106 @@ class EventCollection(Logging.InstanceLogger):
         '''
 
         self.subscriptions = {}
+        self.filters = {}
+        self.plans = {}
+        self.metrics = None
         self.log = self.getLogger()
+        self.cacheLogLevels()
 
         if initial is not None:
             for func in initial:
                 self.subscribe(func.__name__, func)
 
 
-    def subscribe(self, name, handler):
+    def subscribe(self, name, handler, match = None, predicate = None):
         '''
-        Subscribe callable <handler> to event named <name>.
+        Subscribe callable <handler> to event named <name>, which may be a
+        wildcard pattern. If the mapping <match> is given, only call
+        <handler> for events whose headers have the values in <match>. If
+        <predicate> is given, only call <handler> for events for which
+        predicate(event) is true.
         '''
 
-        if name not in self.subscriptions:
-            subscriptions = self.subscriptions[name] = []
+        if match or predicate is not None:
+            filters = self.filters.setdefault(name, [])
+            if handler in [ x[0] for x in filters ]:
+                raise SubscriptionError('Subscription error.')
+
+            items = match and sorted([ (k, str(v)) for (k, v) in match.items() ])
+            filters.append((handler, items or (), predicate))
+
         else:
-            subscriptions = self.subscriptions[name]
+            subscriptions = self.subscriptions.setdefault(name, [])
+            if handler in subscriptions:
+                raise SubscriptionError('Subscription error.')
 
-        if handler in subscriptions:
-            raise SubscriptionError('Subscription error.')
+            subscriptions.append(handler)
 
-        subscriptions.append(handler)
+        self.plans.clear()
 
 
     def unsubscribe(self, name, handler):
         'Unsubscribe callable <handler> to event named <name>.'
-        self.subscriptions[name].remove(handler)
+
+        if handler in self.subscriptions.get(name, ()):
+            self.subscriptions[name].remove(handler)
+        else:
+            filters = self.filters[name]
+            filters.remove([ x for x in filters if x[0] == handler ][0])
+
+        self.plans.clear()
 
 
     def clear(self):
         'Destroy all present subscriptions.'
         self.subscriptions.clear()
+        self.filters.clear()
+        self.plans.clear()
+
+
+    @staticmethod
+    def _matches(pattern, name):
+        if pattern == name:
+            return True
+        return pattern == '*' or (('*' in pattern or '?' in pattern or
+            '[' in pattern) and fnmatch.fnmatchcase(name, pattern))
+
+
+    def _plan(self, name):
+        '''
+        Return the (handlers, index, predicates) dispatch plan for events
+        named <name>.
+        '''
+
+        handlers = list(self.subscriptions.get(name, ()))
+        index = {}
+        predicates = []
+
+        for pattern, subscriptions in self.subscriptions.iteritems():
+            if pattern != name and self._matches(pattern, name):
+                handlers.extend(subscriptions)
+
+        for pattern, filters in self.filters.iteritems():
+            if not self._matches(pattern, name):
+                continue
+
+            for handler, items, predicate in filters:
+                if items:
+                    (key, value), rest = items[0], items[1:]
+                    table = index.setdefault(key, {})
+                    table.setdefault(value, []).append((handler, rest, predicate))
+                else:
+                    predicates.append((handler, predicate))
+
+        plan = self.plans[name] = (handlers, index.items(), predicates)
+        return plan
+
+
+    def wants(self, name):
+        'Return truth if any handler is interested in events named <name>.'
+
+        handlers, index, predicates = self.plans.get(name) or self._plan(name)
+        return bool(handlers or index or predicates)
 
 
     def fire(self, name, *args, **kwargs):
@@ -97,15 +372,67 @@ class EventCollection(Logging.InstanceLogger):
         returning the return value of the last called subscriber.
         '''
 
-        if name not in self.subscriptions:
-            return
+        plan = self.plans.get(name) or self._plan(name)
+        return_value = None
+
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.time()
+
+        for subscription in plan[0]:
+            if self.log_debug:
+                self.log.debug('calling %r(*%r, **%r)', subscription, args, kwargs)
+            return_value = subscription(*args, **kwargs)
+
+        if metrics is not None:
+            metrics.event_handled(name, time.time() - started)
+
+        return return_value
 
 
+    def fire_event(self, manager, event):
+        '''
+        Fire the Manager API <event> received by <manager> to every subscriber
+        interested in it, including those restricted by header values or
+        predicates. Return the return value of the last called subscriber.
+        '''
+
+        name = event.get('Event')
+        handlers, index, predicates = self.plans.get(name) or self._plan(name)
         return_value = None
+        debug = self.log_debug
 
-        for subscription in self.subscriptions[name]:
-            self.log.debug('calling %r(*%r, **%r)', subscription, args, kwargs)
-            return_value = subscription(*args, **kwargs)
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.time()
+
+        for handler in handlers:
+            if debug:
+                self.log.debug('calling %r(%r, %r)', handler, manager, event)
+            return_value = handler(manager, event)
+
+        for key, table in index:
+            value = event.get(key)
+            if value is None:
+                continue
+
+            for handler, rest, predicate in table.get(str(value), ()):
+                if rest and [ k for (k, v) in rest if str(event.get(k)) != v ]:
+                    continue
+
+                if predicate is None or predicate(event):
+                    if debug:
+                        self.log.debug('calling %r(%r, %r)', handler, manager, event)
+                    return_value = handler(manager, event)
+
+        for handler, predicate in predicates:
+            if predicate(event):
+                if debug:
+                    self.log.debug('calling %r(%r, %r)', handler, manager, event)
+                return_value = handler(manager, event)
+
+        if metrics is not None:
+            metrics.event_handled(name, time.time() - started)
 
         return return_value
 
@@ -114,9 +441,18 @@ class EventCollection(Logging.InstanceLogger):
         new = self.__class__()
 
         for name, subscriptions in self.subscriptions.iteritems():
-            new.subscriptions[name] = []
-            for subscription in subscriptions:
-                new.subscriptions[name].append(subscription)
+            new.subscriptions[name] = list(subscriptions)
+
+        for name, filters in self.filters.iteritems():
+            new.filters[name] = list(filters)
+
+        return new
+
+
+    def _restore(self, saved):
+        self.subscriptions = saved.subscriptions
+        self.filters = saved.filters
+        self.plans.clear()
 
 
     def __iadd__(self, collection):
@@ -131,8 +467,12 @@ class EventCollection(Logging.InstanceLogger):
             for name, handlers in collection.subscriptions.iteritems():
                 for handler in handlers:
                     self.subscribe(name, handler)
+
+            for name, filters in collection.filters.iteritems():
+                for handler, items, predicate in filters:
+                    self.subscribe(name, handler, dict(items), predicate)
         except Exception, e:
-            self.subscriptions = new.subscriptions
+            self._restore(new)
             raise
 
         return self
@@ -150,8 +490,12 @@ class EventCollection(Logging.InstanceLogger):
             for name, handlers in collection.subscriptions.iteritems():
                 for handler in handlers:
                     self.unsubscribe(name, handler)
+
+            for name, filters in collection.filters.iteritems():
+                for handler, items, predicate in filters:
+                    self.unsubscribe(name, handler)
         except Exception, e:
-            self.subscriptions = new.subscriptions
+            self._restore(new)
             raise
 
         return self
@@ -187,12 +531,12 @@ def dump_packet(packet, file = sys.stdout):
 
 def dump_human(data, file = sys.stdout, _indent = 0):
     scalars = (str, int, float)
-    recursive = (dict, list, tuple, AttributeDict)
+    recursive = (dict, list, tuple, AttributeDict, Packet)
     indent = lambda a = 0, i = _indent: ('   ' * (a + i))
     Type = type(data)
 
 
-    if Type in (dict, AttributeDict):
+    if Type in (dict, AttributeDict, Packet):
         items = data.items()
         items.sort()
 
@@ -11,21 +11,87 @@ except:
     __revision__ = None
 
 __version__ = '0.1'
-__all__ = [ 'CLI', 'Config', 'Logging', 'Manager', 'Util' ]
+__all__ = [ 'Async', 'CLI', 'Campaign', 'Capture', 'Cluster', 'Config',
+    'Correlator', 'Executor', 'Logging', 'Manager', 'Metrics', 'Pool',
+    'Protocol', 'State', 'Threaded', 'Traffic', 'Util' ]
 
 
 
+# Q.850 cause codes, as reported in the Cause header of Hangup events:
+# code: (code, name, description).
+
 cause_codes = {
-     0: (  0, 'UNKNOWN',        'Unkown'                    ),
-     1: (  1, 'UNALLOCATED',    'Unallocated number'        ),
-    16: ( 16, 'CLEAR',          'Normal call clearing'      ),
-    17: ( 17, 'BUSY',           'User busy'                 ),
-    18: ( 18, 'NOUSER',         'No user responding'        ),
-    21: ( 21, 'REJECTED',       'Call rejected'             ),
-    22: ( 22, 'CHANGED',        'Number changed'            ),
-    27: ( 27, 'DESTFAIL',       'Destination out of order'  ),
-    28: ( 28, 'NETFAIL',        'Network out of order'      ),
-    41: ( 41, 'TEMPFAIL',       'Temporary failure'         )
+      0: (   0, 'UNKNOWN',                      'Unkown'),
+      1: (   1, 'UNALLOCATED',                  'Unallocated number'),
+      2: (   2, 'NO_ROUTE_TRANSIT_NET',         'No route to specified transit network'),
+      3: (   3, 'NO_ROUTE_DESTINATION',         'No route to destination'),
+      4: (   4, 'SPECIAL_INFO_TONE',            'Send special information tone'),
+      5: (   5, 'MISDIALLED_TRUNK_PREFIX',      'Misdialled trunk prefix'),
+      6: (   6, 'CHANNEL_UNACCEPTABLE',         'Channel unacceptable'),
+      7: (   7, 'CALL_AWARDED_DELIVERED',       'Call awarded and being delivered'),
+      8: (   8, 'PRE_EMPTED',                   'Preemption'),
+      9: (   9, 'PRE_EMPTED_RESERVED',          'Preemption, circuit reserved for reuse'),
+     14: (  14, 'NUMBER_PORTED_NOT_HERE',       'Number ported, not here'),
+     16: (  16, 'CLEAR',                        'Normal call clearing'),
+     17: (  17, 'BUSY',                         'User busy'),
+     18: (  18, 'NOUSER',                       'No user responding'),
+     19: (  19, 'NOANSWER',                     'No answer from user'),
+     20: (  20, 'SUBSCRIBER_ABSENT',            'Subscriber absent'),
+     21: (  21, 'REJECTED',                     'Call rejected'),
+     22: (  22, 'CHANGED',                      'Number changed'),
+     23: (  23, 'REDIRECTED',                   'Redirected to new destination'),
+     25: (  25, 'ROUTING_ERROR',                'Exchange routing error'),
+     26: (  26, 'ANSWERED_ELSEWHERE',           'Non-selected user clearing'),
+     27: (  27, 'DESTFAIL',                     'Destination out of order'),
+     28: (  28, 'INVALID_NUMBER_FORMAT',        'Invalid number format'),
+     29: (  29, 'FACILITY_REJECTED',            'Facility rejected'),
+     30: (  30, 'STATUS_ENQUIRY',               'Response to STATUS ENQUIRY'),
+     31: (  31, 'NORMAL_UNSPECIFIED',           'Normal, unspecified'),
+     34: (  34, 'CONGESTION',                   'No circuit/channel available'),
+     38: (  38, 'NETFAIL',                      'Network out of order'),
+     39: (  39, 'FRAME_MODE_OOS',               'Frame mode connection out of service'),
+     40: (  40, 'FRAME_MODE_OPERATIONAL',       'Frame mode connection operational'),
+     41: (  41, 'TEMPFAIL',                     'Temporary failure'),
+     42: (  42, 'SWITCH_CONGESTION',            'Switching equipment congestion'),
+     43: (  43, 'ACCESS_INFO_DISCARDED',        'Access information discarded'),
+     44: (  44, 'CHANNEL_UNAVAILABLE',          'Requested circuit/channel not available'),
+     46: (  46, 'PRECEDENCE_BLOCKED',           'Precedence call blocked'),
+     47: (  47, 'RESOURCE_UNAVAILABLE',         'Resource unavailable, unspecified'),
+     49: (  49, 'QOS_UNAVAILABLE',              'Quality of service not available'),
+     50: (  50, 'FACILITY_NOT_SUBSCRIBED',      'Requested facility not subscribed'),
+     53: (  53, 'OUTGOING_CUG_BARRED',          'Outgoing calls barred within CUG'),
+     55: (  55, 'INCOMING_CUG_BARRED',          'Incoming calls barred within CUG'),
+     57: (  57, 'BEARER_NOT_AUTHORIZED',        'Bearer capability not authorized'),
+     58: (  58, 'BEARER_NOT_AVAILABLE',         'Bearer capability not presently available'),
+     62: (  62, 'OUTGOING_ACCESS_INCONSISTENT', 'Outgoing access inconsistent with class'),
+     63: (  63, 'SERVICE_UNAVAILABLE',          'Service or option not available'),
+     65: (  65, 'BEARER_NOT_IMPLEMENTED',       'Bearer capability not implemented'),
+     66: (  66, 'CHANNEL_TYPE_NOT_IMPLEMENTED', 'Channel type not implemented'),
+     69: (  69, 'FACILITY_NOT_IMPLEMENTED',     'Requested facility not implemented'),
+     70: (  70, 'RESTRICTED_BEARER_ONLY',       'Only restricted digital bearer available'),
+     79: (  79, 'SERVICE_NOT_IMPLEMENTED',      'Service or option not implemented'),
+     81: (  81, 'INVALID_CALL_REFERENCE',       'Invalid call reference value'),
+     82: (  82, 'NO_SUCH_CHANNEL',              'Identified channel does not exist'),
+     83: (  83, 'NO_SUSPENDED_CALL_IDENTITY',   'No suspended call with this identity'),
+     84: (  84, 'CALL_IDENTITY_IN_USE',         'Call identity in use'),
+     85: (  85, 'NO_CALL_SUSPENDED',            'No call suspended'),
+     86: (  86, 'CALL_IDENTITY_CLEARED',        'Call with this identity was cleared'),
+     87: (  87, 'NOT_CUG_MEMBER',               'User not member of CUG'),
+     88: (  88, 'INCOMPATIBLE_DESTINATION',     'Incompatible destination'),
+     90: (  90, 'NO_SUCH_CUG',                  'Non-existent CUG'),
+     91: (  91, 'INVALID_TRANSIT_NETWORK',      'Invalid transit network selection'),
+     95: (  95, 'INVALID_MESSAGE',              'Invalid message, unspecified'),
+     96: (  96, 'MANDATORY_IE_MISSING',         'Mandatory information element is missing'),
+     97: (  97, 'MESSAGE_TYPE_NONEXISTENT',     'Message type not implemented'),
+     98: (  98, 'WRONG_MESSAGE',                'Message not compatible or not implemented'),
+     99: (  99, 'IE_NONEXISTENT',               'Information element not implemented'),
+    100: ( 100, 'INVALID_IE_CONTENTS',          'Invalid information element contents'),
+    101: ( 101, 'WRONG_CALL_STATE',             'Message not compatible with call state'),
+    102: ( 102, 'RECOVERY_ON_TIMER_EXPIRE',     'Recovery on timer expiry'),
+    103: ( 103, 'PARAMETER_NOT_IMPLEMENTED',    'Parameter not implemented'),
+    110: ( 110, 'UNRECOGNIZED_PARAMETER',       'Unrecognized parameter discarded'),
+    111: ( 111, 'PROTOCOL_ERROR',               'Protocol error, unspecified'),
+    127: ( 127, 'INTERWORKING',                 'Interworking, unspecified')
 }
 
 
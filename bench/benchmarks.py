@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+'''
+Offline py-Asterisk benchmarks, run against a local FakeAsterisk server.
+Usage:
+
+    benchmarks.py [--quick] [--output <file>] [--events <file>] [<name> ..]
+
+Results are written as a JSON document, one record per benchmark, so that
+runs from different releases may be compared. <name> selects benchmarks by
+name prefix; --events replays event packets from a text capture instead of
+the synthetic corpus.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import sys, os, time, json, gc, platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import Asterisk, Asterisk.Util
+from Asterisk import Protocol
+from Asterisk.Manager import CoreManager, GoneAwayError
+import fakeami
+
+
+
+
+BENCHMARKS = []
+
+def benchmark(func):
+    'Register <func> as a benchmark.'
+    BENCHMARKS.append(func)
+    return func
+
+
+
+
+def timed(func, *args):
+    'Return (seconds, result) for calling func(*args) with GC disabled.'
+
+    gc.collect()
+    gc.disable()
+    try:
+        started = time.time()
+        result = func(*args)
+        return time.time() - started, result
+    finally:
+        gc.enable()
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+
+
+@benchmark
+def parse_throughput(opts):
+    'Parser.feed() throughput over the event corpus, in 64KiB blocks.'
+
+    data = ''.join(opts['events'])
+    blocks = [ data[i:i + 65536] for i in xrange(0, len(data), 65536) ]
+    results = []
+
+    for name, packet_class in (('AttributeDict', Asterisk.Util.AttributeDict),
+            ('Packet', Asterisk.Util.Packet)):
+        def run():
+            parser = Protocol.Parser(packet_class = packet_class)
+            count = 0
+            for block in blocks:
+                count += len(parser.feed(block))
+            return count
+
+        seconds, count = timed(run)
+        results.append({ 'variant': name, 'packets': count,
+            'seconds': seconds, 'packets_per_second': count / seconds,
+            'bytes_per_second': len(data) / seconds })
+
+    return results
+
+
+@benchmark
+def read_packet(opts):
+    '_read_packet() throughput reading the event corpus from a socket.'
+
+    events = opts['events']
+    server = fakeami.FakeAsterisk(events = events)
+    manager = CoreManager(server.address, 'bench', 'bench')
+
+    def run():
+        for count in xrange(len(events)):
+            manager._read_packet()
+        return count + 1
+
+    seconds, count = timed(run)
+    server.close()
+    return { 'packets': count, 'seconds': seconds,
+        'packets_per_second': count / seconds }
+
+
+@benchmark
+def read_response_latency(opts):
+    'Ping round trip time through read_response() under a paced event load.'
+
+    rate = opts['event_rate']
+    server = fakeami.FakeAsterisk(events = opts['events'], event_rate = rate,
+        event_loops = None)
+    manager = CoreManager(server.address, 'bench', 'bench')
+    samples = []
+
+    for nr in xrange(opts['pings']):
+        started = time.time()
+        manager.Ping()
+        samples.append(time.time() - started)
+
+    server.close()
+    return { 'event_rate': rate, 'actions': len(samples),
+        'mean': sum(samples) / len(samples), 'p50': percentile(samples, 0.5),
+        'p99': percentile(samples, 0.99), 'max': max(samples) }
+
+
+@benchmark
+def snapshot_assembly(opts):
+    'Status() and QueueStatus() snapshot assembly time.'
+
+    server = fakeami.FakeAsterisk(channels = opts['channels'],
+        queues = opts['queues'], members = opts['members'])
+    manager = CoreManager(server.address, 'bench', 'bench',
+        listen_events = False)
+    results = []
+
+    for name, action, size in (
+            ('Status', manager.Status, opts['channels']),
+            ('QueueStatus', manager.QueueStatus,
+                opts['queues'] * (opts['members'] + 2))):
+        samples = [ timed(action)[0] for nr in xrange(opts['repeat']) ]
+        results.append({ 'variant': name, 'events': size,
+            'mean': sum(samples) / len(samples), 'min': min(samples) })
+
+    server.close()
+    return results
+
+
+@benchmark
+def event_dispatch(opts):
+    'EventCollection.fire_event() dispatch to a mix of subscriptions.'
+
+    packets = []
+    for event in opts['events']:
+        packets.extend(Protocol.Parser().feed(event))
+
+    events = Asterisk.Util.EventCollection()
+    handler = lambda manager, event: None
+
+    for name in ('Newchannel', 'Newstate', 'Newexten', 'Hangup'):
+        events.subscribe(name, lambda manager, event: None)
+    events.subscribe('New*', handler)
+    events.subscribe('*', lambda manager, event: None,
+        match = { 'Channel': 'SIP/0001-00000001' })
+    events.subscribe('Hangup', lambda manager, event: None,
+        predicate = lambda event: event.get('Cause') == '17')
+
+    def run():
+        fire_event = events.fire_event
+        for packet in packets:
+            fire_event(None, packet)
+        return len(packets)
+
+    seconds, count = timed(run)
+    return { 'events': count, 'seconds': seconds,
+        'events_per_second': count / seconds }
+
+
+@benchmark
+def command_output(opts):
+    'Command() round trip and output parsing time.'
+
+    server = fakeami.FakeAsterisk(command_lines = opts['command_lines'])
+    manager = CoreManager(server.address, 'bench', 'bench',
+        listen_events = False)
+    samples = [ timed(manager.Command, 'core show channels')[0]
+        for nr in xrange(opts['repeat']) ]
+
+    server.close()
+    return { 'lines': opts['command_lines'], 'mean': sum(samples) / len(samples),
+        'min': min(samples) }
+
+
+
+
+def main(argv):
+    opts = {
+        'corpus': 200000, 'event_rate': 5000, 'pings': 500, 'channels': 5000,
+        'queues': 20, 'members': 50, 'command_lines': 3000, 'repeat': 10,
+        'output': None, 'events': None,
+    }
+
+    names = []
+    args = list(argv)
+
+    while args:
+        arg = args.pop(0)
+        if arg == '--quick':
+            opts.update(corpus = 20000, pings = 100, channels = 500,
+                command_lines = 300, repeat = 3)
+        elif arg == '--output':
+            opts['output'] = args.pop(0)
+        elif arg == '--events':
+            opts['events'] = fakeami.recorded_events(args.pop(0))
+        else:
+            names.append(arg)
+
+    if opts['events'] is None:
+        opts['events'] = fakeami.synthetic_events(opts['corpus'])
+
+    report = {
+        'version': Asterisk.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started': time.time(),
+        'results': [],
+    }
+
+    for func in BENCHMARKS:
+        if names and not [ n for n in names if func.__name__.startswith(n) ]:
+            continue
+
+        sys.stderr.write('%s...\n' % (func.__name__,))
+        try:
+            result = func(opts)
+        except GoneAwayError, e:
+            result = { 'error': str(e) }
+
+        report['results'].append({ 'name': func.__name__,
+            'description': func.__doc__, 'result': result })
+
+    text = json.dumps(report, indent = 2, sort_keys = True)
+
+    if opts['output'] is None:
+        print text
+    else:
+        open(opts['output'], 'w').write(text + '\n')
+
+
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
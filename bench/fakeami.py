@@ -0,0 +1,303 @@
+'''
+bench/fakeami.py: a local stand-in for the Asterisk Manager API.
+
+FakeAsterisk accepts Manager connections, sends the banner, accepts any Login,
+answers the actions used by the benchmarks, and can stream synthetic or
+recorded events to each client at a configurable rate.
+'''
+
+__author__ = 'David Wilson'
+__id__ = '$Id$'
+
+import socket, threading, time, itertools
+
+
+
+
+BANNER = 'Asterisk Call Manager/1.1\r\n'
+
+
+
+
+def format_packet(items):
+    'Return the wire text for the list of (key, value) tuples <items>.'
+    return ''.join([ '%s: %s\r\n' % item for item in items ]) + '\r\n'
+
+
+
+
+def synthetic_events(count, channels = 50):
+    '''
+    Return a list of <count> event packets, in wire format, resembling the
+    Newchannel/Newstate/Newexten/Hangup traffic of a busy PBX.
+    '''
+
+    events = []
+
+    for nr in xrange(count):
+        channel = 'SIP/%04d-%08x' % (nr % channels, nr)
+        uniqueid = '1300000000.%d' % nr
+        kind = nr % 4
+
+        if kind == 0:
+            items = [ ('Event', 'Newchannel'), ('Privilege', 'call,all'),
+                ('Channel', channel), ('State', 'Down'),
+                ('CallerIDNum', '%04d' % (nr % channels)),
+                ('CallerIDName', 'Agent %d' % (nr % channels)),
+                ('Uniqueid', uniqueid) ]
+        elif kind == 1:
+            items = [ ('Event', 'Newstate'), ('Privilege', 'call,all'),
+                ('Channel', channel), ('State', 'Up'),
+                ('CallerID', '%04d' % (nr % channels)), ('Uniqueid', uniqueid) ]
+        elif kind == 2:
+            items = [ ('Event', 'Newexten'), ('Privilege', 'call,all'),
+                ('Channel', channel), ('Context', 'default'),
+                ('Extension', '100'), ('Priority', '1'),
+                ('Application', 'Dial'), ('AppData', 'SIP/100|30'),
+                ('Uniqueid', uniqueid) ]
+        else:
+            items = [ ('Event', 'Hangup'), ('Privilege', 'call,all'),
+                ('Channel', channel), ('Uniqueid', uniqueid), ('Cause', '16'),
+                ('Cause-txt', 'Normal Clearing') ]
+
+        events.append(format_packet(items))
+
+    return events
+
+
+
+
+def recorded_events(pathname):
+    '''
+    Return the event packets found in the text file <pathname>, which holds
+    raw Manager API packets separated by blank lines.
+    '''
+
+    data = open(pathname).read().replace('\r\n', '\n')
+    return [ format_packet([ tuple(line.split(': ', 1)) for line in chunk.split('\n') ])
+        for chunk in data.split('\n\n') if chunk.strip() ]
+
+
+
+
+class FakeAsterisk(object):
+    '''
+    Threaded fake Manager API server listening on a local port.
+
+        <channels>      Number of channels reported by Status.
+        <queues>        Number of queues reported by QueueStatus.
+        <members>       Members per queue reported by QueueStatus.
+        <command_lines> Output lines returned by the Command action.
+        <events>        List of event packets streamed to every client after
+                        login, cycled <event_loops> times (forever if None).
+        <event_rate>    Events per second to stream, or None for as fast as
+                        possible.
+    '''
+
+    def __init__(self, channels = 100, queues = 10, members = 20,
+            command_lines = 100, events = None, event_rate = None,
+            event_loops = 1, address = ('127.0.0.1', 0)):
+        self.channels = channels
+        self.queues = queues
+        self.members = members
+        self.command_lines = command_lines
+        self.events = events or []
+        self.event_rate = event_rate
+        self.event_loops = event_loops
+        self.variables = {}
+        self.closing = False
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+
+        self._start(self._accept)
+
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target = target, args = args)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+
+    def close(self):
+        'Stop accepting connections.'
+
+        self.closing = True
+        self.sock.close()
+
+
+    def _accept(self):
+        while not self.closing:
+            try:
+                conn, peer = self.sock.accept()
+            except socket.error:
+                return
+
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._start(self._serve, conn)
+
+
+    def _serve(self, conn):
+        lock = threading.Lock()
+        conn.sendall(BANNER)
+        data = ''
+
+        try:
+            while True:
+                block = conn.recv(65536)
+                if not block:
+                    return
+
+                data += block
+                requests = data.split('\r\n\r\n')
+                data = requests.pop()
+
+                replies = []
+                stream = False
+                for request in requests:
+                    action = dict([ line.split(': ', 1)
+                        for line in request.split('\r\n') if ': ' in line ])
+                    replies.append(self.handle(action))
+                    stream = stream or action.get('Action', '').lower() == 'login'
+
+                lock.acquire()
+                try:
+                    conn.sendall(''.join(replies))
+                finally:
+                    lock.release()
+
+                # Events only start once the client has its Login response.
+                if stream and self.events:
+                    self._start(self._stream, conn, lock)
+
+        except socket.error:
+            pass
+
+
+    def _stream(self, conn, lock):
+        'Send our events to <conn>, paced to event_rate if set.'
+
+        if self.event_loops is None:
+            events = itertools.cycle(self.events)
+        else:
+            events = itertools.chain(*([ self.events ] * self.event_loops))
+
+        # Pace slow streams in small steps rather than bursts.
+        batch = self.event_rate and max(1, min(64, int(self.event_rate / 100))) or 64
+        started = time.time()
+        sent = 0
+
+        try:
+            while True:
+                chunk = list(itertools.islice(events, batch))
+                if not chunk:
+                    return
+
+                lock.acquire()
+                try:
+                    conn.sendall(''.join(chunk))
+                finally:
+                    lock.release()
+
+                sent += len(chunk)
+                if self.event_rate:
+                    delay = started + float(sent) / self.event_rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+
+        except socket.error:
+            pass
+
+
+    def handle(self, action):
+        'Return the reply text for the request mapping <action>.'
+
+        name = action.get('Action', '').lower()
+        id = action.get('ActionID', '')
+        handler = getattr(self, 'action_' + name, None)
+
+        if handler is None:
+            return format_packet([ ('Response', 'Success'), ('ActionID', id),
+                ('Message', 'Ok') ])
+
+        return handler(action, id)
+
+
+    def action_login(self, action, id):
+        return format_packet([ ('Response', 'Success'), ('ActionID', id),
+            ('Message', 'Authentication accepted') ])
+
+    def action_logoff(self, action, id):
+        return format_packet([ ('Response', 'Goodbye'), ('ActionID', id),
+            ('Message', 'Thanks for all the fish.') ])
+
+    def action_ping(self, action, id):
+        return format_packet([ ('Response', 'Pong'), ('ActionID', id) ])
+
+    def action_command(self, action, id):
+        lines = [ '%-20s %-20s %-10s %s' % ('SIP/%04d-%08x' % (nr, nr),
+            '100@default:1', 'Up', 'Dial(SIP/100|30)')
+            for nr in xrange(self.command_lines) ]
+
+        return 'Response: Follows\r\nPrivilege: Command\r\nActionID: %s\r\n' \
+            '%s\n--END COMMAND--\r\n\r\n' % (id, '\n'.join(lines))
+
+    def action_getvar(self, action, id):
+        value = self.variables.get((action.get('Channel'), action.get('Variable')), '(null)')
+        return format_packet([ ('Response', 'Success'), ('ActionID', id),
+            ('Variable', action.get('Variable')), ('Value', value) ])
+
+    def action_setvar(self, action, id):
+        key = (action.get('Channel'), action.get('Variable'))
+        self.variables[key] = action.get('Value')
+        return format_packet([ ('Response', 'Success'), ('ActionID', id),
+            ('Message', 'Variable Set') ])
+
+    def action_status(self, action, id):
+        packets = [ format_packet([ ('Response', 'Success'), ('ActionID', id),
+            ('Message', 'Channel status will follow') ]) ]
+
+        for nr in xrange(self.channels):
+            packets.append(format_packet([ ('Event', 'Status'),
+                ('Privilege', 'Call'), ('Channel', 'SIP/%04d-%08x' % (nr, nr)),
+                ('CallerID', '%04d' % nr), ('CallerIDName', 'Agent %d' % nr),
+                ('Account', ''), ('State', 'Up'), ('Context', 'default'),
+                ('Extension', '100'), ('Priority', '1'), ('Seconds', str(nr)),
+                ('Uniqueid', '1300000000.%d' % nr), ('ActionID', id) ]))
+
+        packets.append(format_packet([ ('Event', 'StatusComplete'),
+            ('ActionID', id), ('Items', str(self.channels)) ]))
+        return ''.join(packets)
+
+    def action_queuestatus(self, action, id):
+        packets = [ format_packet([ ('Response', 'Success'), ('ActionID', id),
+            ('Message', 'Queue status will follow') ]) ]
+
+        for queue in xrange(self.queues):
+            name = 'queue%d' % queue
+            packets.append(format_packet([ ('Event', 'QueueParams'),
+                ('Queue', name), ('Max', '0'), ('Calls', '1'),
+                ('Holdtime', '12'), ('Completed', '100'), ('Abandoned', '3'),
+                ('ServiceLevel', '60'), ('ServicelevelPerf', '95.0'),
+                ('Weight', '0'), ('ActionID', id) ]))
+
+            for member in xrange(self.members):
+                packets.append(format_packet([ ('Event', 'QueueMember'),
+                    ('Queue', name), ('Location', 'SIP/%04d' % member),
+                    ('Membership', 'static'), ('Penalty', '0'),
+                    ('CallsTaken', str(member)), ('LastCall', '0'),
+                    ('Status', '1'), ('Paused', '0'), ('ActionID', id) ]))
+
+            packets.append(format_packet([ ('Event', 'QueueEntry'),
+                ('Queue', name), ('Position', '1'),
+                ('Channel', 'SIP/caller%d-0001' % queue),
+                ('CallerID', '5550%03d' % queue), ('Wait', '10'),
+                ('ActionID', id) ]))
+
+        packets.append(format_packet([ ('Event', 'QueueStatusComplete'),
+            ('ActionID', id) ]))
+        return ''.join(packets)